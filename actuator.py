@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import heatbot
+from configurations import Configuration
+
+DEFAULT_WORKERS = 4
+
+_lock = threading.Condition()
+_lanes = dict()
+_adapter_slots = dict()
+_executor = None
+
+
+class Operation:
+    def __init__(self, lane, action, args, adapter):
+        self.lane = lane
+        self.action = action
+        self.args = args
+        self.adapter = adapter
+        self.callbacks = list()
+
+
+def adapter_slots(adapter):
+    with _lock:
+        if adapter not in _adapter_slots:
+            _adapter_slots[adapter] = threading.BoundedSemaphore(Configuration.MaxConnectionsPerAdapter)
+        return _adapter_slots[adapter]
+
+
+def submit(lane, action, callback, *args, adapter=None):
+    """
+    Queues action(*args) on lane. Operations on the same lane run one at a time and in order, while different
+    lanes run concurrently, up to MaxConnectionsPerAdapter at a time on each adapter.
+    If the last operation queued on the lane is the same action and hasn't finished yet, the caller joins it
+    instead, and is answered from its single result.
+    """
+    with _lock:
+        lane_operations = _lanes.setdefault(lane, collections.deque())
+        if len(lane_operations) > 0:
+            last_operation = lane_operations[-1]
+            if last_operation.action is action and last_operation.args == args:
+                last_operation.callbacks.append(callback)
+                return
+
+        operation = Operation(lane, action, args, adapter)
+        operation.callbacks.append(callback)
+        lane_operations.append(operation)
+        if len(lane_operations) > 1:
+            return  # Started once the operations before it are done
+    _executor.submit(run_operation, operation)
+
+
+async def execute(lane, action, *args, adapter=None):
+    """
+    Like submit(), for coroutines: awaits the result of action(*args) without holding a thread while it runs on
+    the lane, however many are waiting.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def on_result(result):
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+    submit(lane, action, on_result, *args, adapter=adapter)
+    return await future
+
+
+def is_busy(lane):
+    with _lock:
+        return lane in _lanes
+
+
+def run_operation(operation):
+    try:
+        with adapter_slots(operation.adapter):
+            result = operation.action(*operation.args)
+    except Exception as e:
+        heatbot.logger.error(f"Actuation '{operation.action.__name__}' on '{operation.lane}' raised: {e}")
+        result = False
+
+    with _lock:
+        lane_operations = _lanes[operation.lane]
+        lane_operations.popleft()
+        callbacks = list(operation.callbacks)
+        next_operation = lane_operations[0] if len(lane_operations) > 0 else None
+        if next_operation is None:
+            del _lanes[operation.lane]
+            _lock.notify_all()
+
+    if next_operation is not None:
+        _executor.submit(run_operation, next_operation)
+
+    if len(callbacks) > 1:
+        heatbot.logger.info(f"Coalesced {len(callbacks)} requests into one '{operation.action.__name__}' "
+                            f"on '{operation.lane}'.")
+    for callback in callbacks:
+        try:
+            callback(result)
+        except Exception as e:
+            heatbot.logger.error(f"Actuation callback failed: {e}")
+
+
+def start(workers=DEFAULT_WORKERS):
+    global _executor
+
+    if _executor is not None:
+        return
+    _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="actuator")
+
+
+def stop(timeout=None):
+    global _executor
+
+    if _executor is None:
+        return
+    with _lock:
+        _lock.wait_for(lambda: len(_lanes) == 0, timeout)
+    _executor.shutdown(wait=False)
+    _executor = None
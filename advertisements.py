@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import heatbot
+
+OGF_LE_CTL = 0x08
+OCF_LE_SET_SCAN_PARAMETERS = 0x000B
+OCF_LE_SET_SCAN_ENABLE = 0x000C
+EVT_LE_META_EVENT = 0x3E
+EVT_LE_ADVERTISING_REPORT = 0x02
+AD_TYPE_SERVICE_DATA = 0x16
+SWITCHBOT_SERVICE_UUIDS = (0x0D00, 0xFD3D)
+SWITCHBOT_BOT_MODEL = 0x48  # 'H'
+SCAN_INTERVAL = 0x0010  # 10ms units of 0.625ms
+SCAN_WINDOW = 0x0010
+MAX_AGE = 120  # Seconds an advertisement is trusted for
+
+State = collections.namedtuple("State", ["is_on", "switch_mode", "battery", "rssi", "last_seen"])
+
+_states = dict()
+_lock = threading.Lock()
+_socket = None
+_stop_event = None
+_pauses = 0
+
+
+def parse_service_data(data):
+    """Decodes a Switchbot Bot's service data into (is_on, switch_mode, battery), or None for other devices."""
+    if len(data) < 3 or data[0] & 0x7F != SWITCHBOT_BOT_MODEL:
+        return None
+    switch_mode = bool(data[1] & 0x80)
+    # The state bit is only meaningful in switch mode, where it is set while the bot is off
+    is_on = switch_mode and not bool(data[1] & 0x40)
+    return is_on, switch_mode, data[2] & 0x7F
+
+
+def parse_advertisement(data):
+    """Walks the AD structures of an advertisement, and decodes the Switchbot service data in it, if any."""
+    offset = 0
+    while offset + 1 < len(data):
+        length = data[offset]
+        if length == 0:
+            break
+        ad_type = data[offset + 1]
+        value = data[offset + 2:offset + 1 + length]
+        if ad_type == AD_TYPE_SERVICE_DATA and len(value) >= 2:
+            uuid = struct.unpack("<H", value[:2])[0]
+            if uuid in SWITCHBOT_SERVICE_UUIDS:
+                return parse_service_data(value[2:])
+        offset += 1 + length
+    return None
+
+
+def parse_reports(packet):
+    """Yields (address, advertisement data, rssi) for each report in an LE advertising report event."""
+    if len(packet) < 5 or packet[1] != EVT_LE_META_EVENT or packet[3] != EVT_LE_ADVERTISING_REPORT:
+        return
+    reports = packet[4]
+    offset = 5
+    for _ in range(reports):
+        if offset + 9 > len(packet):
+            return
+        address = ":".join("%02x" % byte for byte in reversed(packet[offset + 2:offset + 8]))
+        data_length = packet[offset + 8]
+        data = packet[offset + 9:offset + 9 + data_length]
+        rssi = struct.unpack("b", packet[offset + 9 + data_length:offset + 10 + data_length])[0]
+        yield address, data, rssi
+        offset += 10 + data_length
+
+
+def get_state(address):
+    """Returns the last advertised State of the device, or None if it wasn't heard from in MAX_AGE seconds."""
+    with _lock:
+        state = _states.get(address.lower())
+    if state is None or time.time() - state.last_seen > MAX_AGE:
+        return None
+    return state
+
+
+def get_states():
+    with _lock:
+        return dict(_states)
+
+
+def set_scan_enabled(enabled):
+    if _socket is None:
+        return
+
+    import bluetooth._bluetooth as bluez
+    bluez.hci_send_cmd(_socket, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, struct.pack("<BB", int(enabled), 0x00))
+
+
+@contextmanager
+def paused():
+    """Stops scanning for the duration, as many adapters can't scan and connect at the same time."""
+    global _pauses
+
+    with _lock:
+        _pauses += 1
+        if _pauses == 1:
+            try:
+                set_scan_enabled(False)
+            except OSError:
+                pass
+    try:
+        yield
+    finally:
+        with _lock:
+            _pauses -= 1
+            if _pauses == 0 and _stop_event is not None and not _stop_event.is_set():
+                try:
+                    set_scan_enabled(True)
+                except OSError as e:
+                    heatbot.logger.warning(f"Failed to resume advertisement scanning: {e}")
+
+
+def listen(stop_event, on_state):
+    while not stop_event.is_set():
+        try:
+            packet = _socket.recv(255)
+        except OSError:
+            continue  # Timed out, or interrupted while paused
+
+        for address, data, rssi in parse_reports(packet):
+            decoded = parse_advertisement(data)
+            if decoded is None:
+                continue
+            is_on, switch_mode, battery = decoded
+            state = State(is_on, switch_mode, battery, rssi, time.time())
+            with _lock:
+                _states[address] = state
+            try:
+                on_state(address, state)
+            except Exception as e:
+                heatbot.logger.error(f"Handling the advertisement of {address} failed: {e}")
+
+
+def start(bt_interface, on_state, active=True):
+    """
+    Listens to advertisements on bt_interface in the background, caching the state Switchbots advertise,
+    and calling on_state(address, state) for each one.
+    Bots send their service data in scan responses, which only active scanning asks for. Either way, no connection
+    is ever made.
+    """
+    global _socket, _stop_event
+
+    import bluetooth._bluetooth as bluez
+
+    if _socket is not None:
+        return
+    device_id = int(bt_interface[3:]) if bt_interface and bt_interface.startswith("hci") else 0
+    _socket = bluez.hci_open_dev(device_id)
+    _socket.settimeout(1)
+
+    event_filter = bluez.hci_filter_new()
+    bluez.hci_filter_all_events(event_filter)
+    bluez.hci_filter_set_ptype(event_filter, bluez.HCI_EVENT_PKT)
+    _socket.setsockopt(bluez.SOL_HCI, bluez.HCI_FILTER, event_filter)
+
+    parameters = struct.pack("<BHHBB", int(active), SCAN_INTERVAL, SCAN_WINDOW, 0x00, 0x00)
+    bluez.hci_send_cmd(_socket, OGF_LE_CTL, OCF_LE_SET_SCAN_PARAMETERS, parameters)
+    set_scan_enabled(True)
+
+    _stop_event = threading.Event()
+    threading.Thread(target=listen, args=(_stop_event, on_state), name="advertisements", daemon=True).start()
+
+
+def stop():
+    global _socket, _stop_event
+
+    if _socket is None:
+        return
+    _stop_event.set()
+    try:
+        set_scan_enabled(False)
+    except OSError:
+        pass
+    _socket.close()
+    _socket = None
+    _stop_event = None
@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of the full handler -> verifier -> driver -> persistence path.
+Bluetooth is replaced by FakeGATTRequester and Telegram by synthetic updates, so no hardware or bot token is needed.
+
+Example:
+    python benchmark.py --iterations 200 --connect-latency 0.05 --failure-rate 0.05 --max-p99 500
+
+It can also serve a local stand-in for the Telegram Bot API, to run the real bot against, in polling or webhook mode.
+Point TelegramBaseUrl at it (e.g. "http://127.0.0.1:8081/bot"), then type messages to send them as the user,
+or "press <data>" to press a button of the last message with an inline keyboard, e.g. "press panel:on":
+    python benchmark.py --fake-api 8081 --fake-api-user 314704887
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MASTER_ID = "100000001"
+USER_ID = "100000002"
+
+
+class FakeGATTRequester:
+    """
+    Stands in for bluetooth.ble.GATTRequester, with configurable latency and injectable failures.
+    Once subscribed to, it answers commands with notifications, like a Switchbot Bot.
+    """
+    connect_latency = 0.0
+    write_latency = 0.0
+    connect_failure_rate = 0.0
+    write_failure_rate = 0.0
+    random = random.Random(0)
+    connects = 0
+    writes = 0
+
+    def __init__(self, device, wait=False, bt_interface=None):
+        self.device = device
+        self.bt_interface = bt_interface
+        self._connected_at = None
+        self._notifying = False
+
+    def connect(self, wait=False, channel_type="public"):
+        FakeGATTRequester.connects += 1
+        if self.random.random() < self.connect_failure_rate:
+            return  # Never becomes connected, so the driver times out
+        self._connected_at = time.perf_counter() + self.connect_latency
+
+    def is_connected(self):
+        return self._connected_at is not None and time.perf_counter() >= self._connected_at
+
+    def disconnect(self):
+        self._connected_at = None
+        self._notifying = False
+
+    def write_by_handle(self, handle, data):
+        if data == b'\x01\x00':
+            self._notifying = True  # The notification handle's configuration descriptor
+            return [b'\x13']
+        FakeGATTRequester.writes += 1
+        time.sleep(self.write_latency)
+        if self.random.random() < self.write_failure_rate:
+            return [b'\x01']
+        if self._notifying and hasattr(self, "on_notification"):
+            # Status, battery, firmware 6.9, ..., and switch mode in the settings byte
+            response = bytes([0x01, 87, 69, 0, 0, 0, 0, 0, 0, 0x10, 0]) if data == b'\x57\x02' else b'\x01'
+            self.on_notification(0x13, b'\x1b\x13\x00' + response)
+        return [b'\x13']
+
+    def discover_characteristics(self):
+        return [{"uuid": "cba20002-224d-11e6-9fb8-0002a5d5c51b", "value_handle": 0x16}]
+
+
+def install_fake_bluetooth():
+    """Registers a fake bluetooth.ble module, so switchbot_py3 imports without pybluez and gattlib."""
+    bluetooth = types.ModuleType("bluetooth")
+    ble = types.ModuleType("bluetooth.ble")
+    ble.GATTRequester = FakeGATTRequester
+    ble.DiscoveryService = object
+    bluetooth.ble = ble
+    sys.modules["bluetooth"] = bluetooth
+    sys.modules["bluetooth.ble"] = ble
+
+
+class FakeMessage:
+    """A synthetic telegram Message, recording replies and edits instead of calling the Bot API."""
+    api_calls = 0
+
+    def __init__(self, user_id, text="", parent=None):
+        self.message_id = id(self)
+        self.from_user = {"id": int(user_id)}
+        self.text = text
+        self.date = datetime.datetime.now(datetime.timezone.utc)
+        self.parent = parent
+        self.edits = list()
+        self.replies = list()
+
+    async def reply_text(self, text, **kwargs):
+        FakeMessage.api_calls += 1
+        reply = FakeMessage(self.from_user["id"], text, parent=self)
+        self.replies.append(reply)
+        return reply
+
+    async def edit_text(self, text, **kwargs):
+        FakeMessage.api_calls += 1
+        self.text = text
+        self.edits.append(text)
+        return self
+
+
+class FakeCallbackQuery:
+    def __init__(self, message, data):
+        self.message = message
+        self.data = data
+
+    async def answer(self, text=None, **kwargs):
+        FakeMessage.api_calls += 1
+
+
+class FakeUpdate:
+    def __init__(self, user_id, text="", callback_query=None):
+        self.message = FakeMessage(user_id, text) if callback_query is None else None
+        self.effective_user = {"id": int(user_id)}
+        self.effective_chat = types.SimpleNamespace(id=int(user_id))
+        self.callback_query = callback_query
+
+
+class FakeBot:
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        FakeMessage.api_calls += 1
+
+    async def delete_message(self, chat_id=None, message_id=None):
+        FakeMessage.api_calls += 1
+
+
+class FakeContext:
+    def __init__(self, args=None, user_data=None, chat_data=None):
+        self.args = args
+        self.user_data = user_data if user_data is not None else dict()
+        self.chat_data = chat_data if chat_data is not None else dict()
+        self.bot_data = dict()
+        self.bot = FakeBot()
+        self.error = None
+
+
+class FakeBotApi:
+    """A minimal local stand-in for the Telegram Bot API, delivering updates by getUpdates or by webhook."""
+    bot_user = {"id": 1, "is_bot": True, "first_name": "HeatBot", "username": "heatbot"}
+
+    def __init__(self, port, address="127.0.0.1"):
+        self.updates = list()
+        self.webhook_url = None
+        self.webhook_secret_token = None
+        self.calls = list()
+        self.next_id = 1
+        self.keyboard_message = None
+        self.changed = threading.Condition()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.do_POST()
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1].split("?")[0]
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                try:
+                    parameters = json.loads(body) if body else dict()
+                except ValueError:
+                    parameters = dict(urllib.parse.parse_qsl(body.decode()))
+                result = api.handle(method, parameters)
+                data = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def allocate_id(self):
+        with self.changed:
+            self.next_id += 1
+            return self.next_id
+
+    def handle(self, method, parameters):
+        self.calls.append((method, parameters))
+        if method == "getMe":
+            return self.bot_user
+        if method == "setWebhook":
+            self.webhook_url = parameters.get("url") or None
+            self.webhook_secret_token = parameters.get("secret_token") or None
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            self.webhook_secret_token = None
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url or "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getUpdates":
+            offset = int(parameters.get("offset") or 0)
+            timeout = min(float(parameters.get("timeout") or 0), 1)
+            with self.changed:
+                self.changed.wait_for(lambda: any(u["update_id"] >= offset for u in self.updates), timeout)
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+                return list(self.updates)
+        if method in ("sendMessage", "editMessageText"):
+            print(f"<- {method}: {parameters.get('text')}")
+            chat_id = int(parameters.get("chat_id") or 0)
+            message_id = int(parameters.get("message_id") or self.allocate_id())
+            message = {"message_id": message_id, "date": int(time.time()), "text": parameters.get("text"),
+                       "chat": {"id": chat_id, "type": "private"}, "from": self.bot_user}
+            reply_markup = parameters.get("reply_markup")
+            if isinstance(reply_markup, str):
+                reply_markup = json.loads(reply_markup)
+            if reply_markup and "inline_keyboard" in reply_markup:
+                self.keyboard_message = message
+            return message
+        if method == "answerCallbackQuery":
+            print(f"<- {method}: {parameters.get('text') or ''}")
+        return True
+
+    def deliver(self, user_id, text):
+        update_id = self.allocate_id()
+        user = {"id": int(user_id), "is_bot": False, "first_name": "User"}
+        if text.startswith("press ") and self.keyboard_message is not None:
+            update = {"update_id": update_id, "callback_query": {
+                "id": str(update_id), "from": user, "chat_instance": "1", "message": self.keyboard_message,
+                "data": text[len("press "):]}}
+        else:
+            message = {"message_id": update_id, "date": int(time.time()), "text": text,
+                       "chat": {"id": int(user_id), "type": "private"}, "from": user}
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+            update = {"update_id": update_id, "message": message}
+
+        if self.webhook_url is not None:
+            headers = {"Content-Type": "application/json"}
+            if self.webhook_secret_token is not None:
+                headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook_secret_token
+            request = urllib.request.Request(self.webhook_url, data=json.dumps(update).encode(), headers=headers)
+            urllib.request.urlopen(request, timeout=10).close()
+            return
+        with self.changed:
+            self.updates.append(update)
+            self.changed.notify_all()
+
+
+def serve_fake_api(port, user_id):
+    api = FakeBotApi(port)
+    print(f"Fake Bot API listening on 127.0.0.1:{port}, type messages to send them as {user_id}.")
+    for line in sys.stdin:
+        if line.strip():
+            api.deliver(user_id, line.strip())
+            print("-> delivered by " + ("webhook" if api.webhook_url else "getUpdates"))
+
+
+def write_configuration(directory, devices):
+    configuration = {
+        "TelegramAccessToken": "BENCHMARK",
+        "MasterID": MASTER_ID,
+        "Allowed": {MASTER_ID: "Master", USER_ID: "User"},
+        "AutomaticOffInMinutes": 90,
+        # Measure the handlers themselves, not the per-user flood protection
+        "RateLimits": {command_class: {"Rate": 1e9, "Burst": 1e9} for command_class in ("actuation", "query", "admin")},
+    }
+    if devices == 1:
+        configuration["BluetoothAddress"] = "00:00:00:00:00:01"
+    else:
+        configuration["Devices"] = {f"device{i}": {"BluetoothAddress": f"00:00:00:00:00:{i:02x}"}
+                                    for i in range(devices)}
+    with open(os.path.join(directory, "configuration.json"), "w") as conf:
+        conf.write(json.dumps(configuration))
+
+
+def get_fake_arguments(options):
+    return ["--connect-latency", str(options.connect_latency), "--write-latency", str(options.write_latency),
+            "--connect-failure-rate", str(options.connect_failure_rate), "--failure-rate", str(options.failure_rate),
+            "--seed", str(options.seed)]
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Bench:
+    def __init__(self, options):
+        self.options = options
+
+        import heatbot
+        import commands
+        import panel
+        import users
+        import actuator
+        import bleworker
+        import devices
+        import history
+        import scheduler
+        import switchbot_py3
+        from configurations import Configuration
+
+        switchbot_py3.GATTRequester = FakeGATTRequester
+        self.heatbot = heatbot
+        self.commands = commands
+        self.users = users
+        self.panel = panel
+        self.panel_message = FakeMessage(1)
+        self.panel_chat_data = dict()
+        self.devices = devices
+        self.modules = (actuator, bleworker, history, scheduler, switchbot_py3)
+        self.configuration = Configuration
+        self.loop = asyncio.new_event_loop()
+
+        Configuration.load_configuration()
+        history.open_history()
+        actuator.start(max(len(devices.get_devices()), actuator.DEFAULT_WORKERS))
+        scheduler.start()
+        if options.ble_worker:
+            # The worker is this script again, so it fakes Bluetooth the same way
+            bleworker.WORKER_COMMAND = [sys.executable, os.path.abspath(__file__)] + get_fake_arguments(options)
+            bleworker.start()
+
+    def close(self):
+        actuator, bleworker, history, scheduler, switchbot_py3 = self.modules
+        scheduler.stop(1)
+        actuator.stop(10)
+        bleworker.stop()
+        switchbot_py3.close_connections()
+        self.configuration.flush_configuration()
+        history.close_history()
+        self.loop.close()
+
+    async def status(self, i):
+        await self.commands.status(FakeUpdate(USER_ID, "/status"), FakeContext())
+
+    async def help(self, i):
+        await self.heatbot.help(FakeUpdate(USER_ID, "Help"), FakeContext())
+
+    async def users_flow(self, i):
+        user_data = dict()
+        new_user_id = str(200000000 + i)
+        await self.users.get_name(FakeUpdate(MASTER_ID, "/add"), FakeContext(user_data=user_data))
+        await self.users.get_id(FakeUpdate(MASTER_ID, f"user{i}"), FakeContext(user_data=user_data))
+        await self.users.add_user(FakeUpdate(MASTER_ID, new_user_id), FakeContext(user_data=user_data))
+        await self.users.remove_id(FakeUpdate(MASTER_ID, "/remove"), FakeContext(user_data=user_data))
+        await self.users.remove(FakeUpdate(MASTER_ID, new_user_id), FakeContext(user_data=user_data))
+
+    async def actuation(self, i):
+        # The handler returns once every device has reported back, and its reply was edited with the result
+        handler = self.commands.force_on if i % 2 == 0 else self.commands.force_off
+        await handler(FakeUpdate(USER_ID, "/force_on" if i % 2 == 0 else "/force_off"), FakeContext())
+
+    async def panel_button(self, i):
+        # A press on the control panel: an answer to the query, and the panel edited to the progress and the result
+        query = FakeCallbackQuery(self.panel_message, "panel:on" if i % 2 == 0 else "panel:off")
+        await self.panel.button(FakeUpdate(USER_ID, callback_query=query), FakeContext(chat_data=self.panel_chat_data))
+
+    def run(self, scenario, iterations):
+        operation = getattr(self, scenario)
+        for i in range(min(5, iterations)):
+            self.loop.run_until_complete(operation(i))  # Warm up connections, caches and imports
+
+        FakeMessage.api_calls = 0
+        latencies = list()
+        tracemalloc.start()
+        blocks_before = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        start_time = time.perf_counter()
+        for i in range(iterations):
+            operation_start_time = time.perf_counter()
+            self.loop.run_until_complete(operation(i))
+            latencies.append(time.perf_counter() - operation_start_time)
+        elapsed = time.perf_counter() - start_time
+        blocks_after = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            "scenario": scenario,
+            "iterations": iterations,
+            "commands_per_second": iterations / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "mean_ms": statistics.mean(latencies) * 1000,
+            "api_calls_per_command": FakeMessage.api_calls / iterations,
+            "retained_blocks_per_command": (blocks_after - blocks_before) / iterations,
+            "peak_memory_kb": peak_memory / 1024,
+        }
+
+
+INTENT_SAMPLES = ["Status ❔", "ON 💡", "OFF 🍗", "Help 🤷‍♂️", "please turn the heat on", "is it off yet?",
+                  "what is the status now", "hello there", "הדלק", "turn everything off in the bedrooms"]
+
+
+def benchmark_intents(iterations):
+    """Compares the dispatch cost of the intent trie against the MessageHandler regex chain it replaced."""
+    import re
+    import intents
+
+    chain = [re.compile(f"^(.*\\s+)?{word}(\\s+.*)?$") for word in ("[sS]tatus", "[oO][nN]", "[oO][fF][fF]", "[hH]elp")]
+    trie = intents.compile_intents()
+
+    # What the chain would grow to, with a handler per alias of every intent
+    aliases_chain = [re.compile(f"^(.*\\s+)?{re.escape(alias)}(\\s+.*)?$", re.IGNORECASE)
+                     for aliases in intents.DEFAULT_INTENTS.values() for alias in aliases]
+
+    def dispatch_chain(patterns, text):
+        for pattern in patterns:
+            if pattern.search(text):
+                return pattern
+        return None
+
+    results = dict()
+    for name, dispatch in (("regex chain", lambda text: dispatch_chain(chain, text)),
+                           ("aliases chain", lambda text: dispatch_chain(aliases_chain, text)),
+                           ("intent trie", lambda text: intents.match(text, trie))):
+        start_time = time.perf_counter()
+        for _ in range(iterations):
+            for text in INTENT_SAMPLES:
+                dispatch(text)
+        results[name] = (time.perf_counter() - start_time) / (iterations * len(INTENT_SAMPLES))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline HeatBot benchmark")
+    parser.add_argument("--scenario",
+                        choices=["status", "help", "users_flow", "actuation", "panel_button", "intents", "all"],
+                        default="all")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--devices", type=int, default=1, help="Number of fake devices (default: %(default)s)")
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="Seconds per fake connect")
+    parser.add_argument("--write-latency", type=float, default=0.0, help="Seconds per fake write")
+    parser.add_argument("--connect-failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Rate of failed fake writes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-p99", type=float, default=None,
+                        help="Exit with an error if any scenario's p99 exceeds this many milliseconds")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    parser.add_argument("--fake-api", type=int, default=None, metavar="PORT",
+                        help="Serve a local stand-in for the Telegram Bot API instead of benchmarking")
+    parser.add_argument("--fake-api-user", default=MASTER_ID, help="User ID that typed messages are sent as")
+    parser.add_argument("--ble-worker", action="store_true",
+                        help="Send Bluetooth commands through a BLE worker process, as the bot does")
+    parser.add_argument("--serve-fd", type=int, default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.fake_api is not None:
+        serve_fake_api(options.fake_api, options.fake_api_user)
+        return
+
+    FakeGATTRequester.connect_latency = options.connect_latency
+    FakeGATTRequester.write_latency = options.write_latency
+    FakeGATTRequester.connect_failure_rate = options.connect_failure_rate
+    FakeGATTRequester.write_failure_rate = options.failure_rate
+    FakeGATTRequester.random.seed(options.seed)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    install_fake_bluetooth()
+    if options.serve_fd is not None:
+        import switchbot_py3
+        switchbot_py3.serve(options.serve_fd)
+        return
+    working_directory = tempfile.mkdtemp(prefix="heatbot-benchmark-")
+    write_configuration(working_directory, options.devices)
+    os.chdir(working_directory)  # Configuration, history and logs all live in the working directory
+
+    bench = Bench(options)
+    if options.scenario in ("intents", "all"):
+        for name, seconds in benchmark_intents(options.iterations * 10).items():
+            print(f"{name:>13}: {seconds * 1e6:8.2f}us per message")
+        if options.scenario == "intents":
+            bench.close()
+            return
+
+    scenarios = ["status", "help", "users_flow", "actuation", "panel_button"] if options.scenario == "all" else [options.scenario]
+    failed = False
+    try:
+        for scenario in scenarios:
+            result = bench.run(scenario, options.iterations)
+            if options.json:
+                print(json.dumps(result))
+            else:
+                print(f"{scenario:>12}: {result['commands_per_second']:9.1f} cmd/s  "
+                      f"p50 {result['p50_ms']:8.2f}ms  p95 {result['p95_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  "
+                      f"{result['api_calls_per_command']:.1f} API calls/cmd  "
+                      f"{result['retained_blocks_per_command']:.1f} blocks/cmd  "
+                      f"peak {result['peak_memory_kb']:.0f}KB")
+            if options.max_p99 is not None and result["p99_ms"] > options.max_p99:
+                print(f"{scenario} p99 of {result['p99_ms']:.2f}ms exceeds {options.max_p99}ms", file=sys.stderr)
+                failed = True
+    finally:
+        bench.close()
+    if not options.ble_worker:
+        print(f"Fake GATT: {FakeGATTRequester.connects} connects, {FakeGATTRequester.writes} writes.")
+    print(f"Working directory: {working_directory}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import itertools
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import heatbot
+import metrics
+import switchbot_py3
+from configurations import Configuration
+
+HEARTBEAT_INTERVAL = 2  # Seconds
+HEARTBEAT_TIMEOUT = 10  # Seconds without hearing from the worker before it's considered hung
+DEFAULT_DEADLINE = 30  # Seconds a command may take, including connecting to the device
+DEADLINE_GRACE = 2  # Seconds past its deadline before a command is considered stuck in the worker
+STOP_TIMEOUT = 5  # Seconds the worker gets to exit by itself before it's killed
+
+# The worker only imports switchbot_py3, so it starts quickly and never touches the bot's state or log file
+WORKER_COMMAND = [sys.executable, switchbot_py3.__file__]
+
+
+class WorkerError(ConnectionError):
+    pass
+
+
+class Request:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.response = None
+
+
+_lock = threading.Lock()
+_send_lock = threading.Lock()
+_restart_lock = threading.Lock()
+_request_ids = itertools.count(1)
+_pending = dict()
+_process = None
+_socket = None
+_last_heard = 0.0
+_stop_event = None
+
+
+class Driver:
+    """Runs switchbot_py3.Driver commands in the worker process, with the same interface."""
+
+    def __init__(self, device, bt_interface=None, timeout_secs=None):
+        self.device = device
+        self.bt_interface = bt_interface
+        self.timeout_secs = timeout_secs
+        self.connect_time = 0.0
+        self.write_time = 0.0
+
+    def run_commands(self, commands):
+        response = call({"op": "command", "device": self.device, "interface": self.bt_interface,
+                         "timeout": self.timeout_secs, "commands": list(commands)})
+        self.connect_time = response.get("connect_time", 0.0)
+        self.write_time = response.get("write_time", 0.0)
+        if "error" in response:
+            raise ConnectionError(response["error"])
+        return [switchbot_py3.Result.from_dict(result) for result in response["results"]]
+
+    def run_command(self, command):
+        return self.run_commands([command])[0]
+
+
+def is_running():
+    return _process is not None
+
+
+def call(message):
+    """
+    Sends a request to the worker, and waits for its response until the request's deadline.
+    Raises WorkerError if the worker fails to answer in time, and restarts it, as it's probably stuck.
+    """
+    deadline = time.time() + Configuration.BleWorker.get("DeadlineSeconds", DEFAULT_DEADLINE)
+    request = Request(deadline)
+    with _lock:
+        if _process is None:
+            raise WorkerError("The BLE worker isn't running")
+        process, worker_socket = _process, _socket
+        request_id = next(_request_ids)
+        _pending[request_id] = request
+    try:
+        send(worker_socket, dict(message, id=request_id, deadline=deadline))
+    except OSError as e:
+        with _lock:
+            _pending.pop(request_id, None)
+        raise WorkerError(f"Failed to reach the BLE worker: {e}")
+
+    if not request.done.wait(deadline + DEADLINE_GRACE - time.time()):
+        restart(process, f"a '{message['op']}' request missed its deadline")
+    if request.response is None:
+        raise WorkerError("The BLE worker was restarted before it answered")
+    return request.response
+
+
+def send(worker_socket, message):
+    data = (json.dumps(message) + "\n").encode()
+    with _send_lock:
+        worker_socket.sendall(data)
+
+
+def read(process, worker_socket):
+    global _last_heard
+
+    try:
+        with worker_socket.makefile("rb") as stream:
+            for line in stream:
+                response = json.loads(line)
+                with _lock:
+                    if _process is not process:
+                        return
+                    _last_heard = time.monotonic()
+                    request = _pending.pop(response["id"], None)
+                if request is not None:
+                    request.response = response
+                    request.done.set()
+    except (OSError, ValueError) as e:
+        heatbot.logger.warning(f"Reading from the BLE worker failed: {e}")
+
+
+def spawn():
+    global _process, _socket, _last_heard
+
+    worker_socket, child_socket = socket.socketpair()
+    # In its own session, so signals meant for the bot, like a Ctrl-C, don't kill it before the bot is done with it
+    process = subprocess.Popen(WORKER_COMMAND + ["--serve-fd", str(child_socket.fileno())],
+                               pass_fds=(child_socket.fileno(),), stdin=subprocess.DEVNULL, start_new_session=True)
+    child_socket.close()
+    with _lock:
+        _process, _socket, _last_heard = process, worker_socket, time.monotonic()
+    threading.Thread(target=read, args=(process, worker_socket), name="ble-worker-reader", daemon=True).start()
+    heatbot.logger.info(f"Started the BLE worker (pid {process.pid}).")
+
+
+def kill(process, worker_socket, timeout=0):
+    try:
+        worker_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    worker_socket.close()
+    try:
+        process.wait(timeout)  # Closing its socket asks it to exit
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def restart(process, reason):
+    """Replaces process with a fresh worker, failing the requests it didn't answer. Does nothing if it's gone."""
+    with _restart_lock:
+        with _lock:
+            if _process is not process or _stop_event is None or _stop_event.is_set():
+                return
+            worker_socket = _socket
+            requests = list(_pending.values())
+            _pending.clear()
+        heatbot.logger.error(f"Restarting the BLE worker (pid {process.pid}), {reason}.")
+        metrics.increment("ble_worker_restarts_total")
+        kill(process, worker_socket)
+        for request in requests:
+            request.done.set()
+        spawn()
+
+
+def supervise(stop_event):
+    while not stop_event.wait(HEARTBEAT_INTERVAL):
+        with _lock:
+            process, worker_socket = _process, _socket
+            silence = time.monotonic() - _last_heard
+            overdue = sum(1 for request in _pending.values() if time.time() > request.deadline + DEADLINE_GRACE)
+        if process is None:
+            return
+        if process.poll() is not None:
+            restart(process, f"it exited with code {process.returncode}")
+        elif silence > HEARTBEAT_TIMEOUT:
+            restart(process, f"it didn't answer for {silence:.0f} seconds")
+        elif overdue > 0:
+            restart(process, f"{overdue} requests are stuck past their deadline")
+        else:
+            try:
+                send(worker_socket, {"op": "ping", "id": 0})
+            except OSError as e:
+                restart(process, f"sending a heartbeat failed: {e}")
+
+
+def start():
+    """Starts the worker process, and a thread that restarts it whenever it dies, hangs or stops answering."""
+    global _stop_event
+
+    if _stop_event is not None:
+        return
+    _stop_event = threading.Event()
+    spawn()
+    threading.Thread(target=supervise, args=(_stop_event,), name="ble-worker-supervisor", daemon=True).start()
+
+
+def stop(timeout=STOP_TIMEOUT):
+    global _process, _socket, _stop_event
+
+    if _stop_event is None:
+        return
+    _stop_event.set()
+    with _restart_lock:
+        with _lock:
+            process, worker_socket = _process, _socket
+            requests = list(_pending.values())
+            _pending.clear()
+            _process, _socket, _stop_event = None, None, None
+        kill(process, worker_socket, timeout)
+    for request in requests:
+        request.done.set()
@@ -1,56 +1,159 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
 import datetime
+import functools
+import threading
 import time
 
 from telegram.ext import ConversationHandler
 import switchbot_py3
 
+import actuator
+import advertisements
+import bleworker
+import devices
 import heatbot
+import history
+import metrics
+import notifications
+import panel
+import retries
+import scheduler
 import verifier
 from configurations import Configuration
 
-LOG = list()
-LOG_SIZE = 15
-AUTOMATIC_OFF_THREAD_INTERVALS = 5 * 60  # 5 Minutes
-AUTOMATIC_OFF_THREAD_SLEEP = 5  # 5 Seconds
-
-def add_to_log(update, action):
-    global LOG
-
+AUTOMATIC_OFF_TIMER = "automatic off"
+AUTOMATIC_OFF_RETRY_SECONDS = 60
+SHUTDOWN_TIMEOUT = 10  # Seconds
+SWITCHBOT_REGISTRY = switchbot_py3.Registry()
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_RETRY_BASE_DELAY = 0.5
+DEFAULT_RETRY_MAX_DELAY = 4.0
+DEFAULT_BREAKER_THRESHOLD = 3
+DEFAULT_BREAKER_RESET_SECONDS = 60
+RECONCILE_GRACE_SECONDS = 30
+RECONCILE_CONFIRMATIONS = 2
+INFO_INTERVAL = 6 * 60 * 60  # Seconds between reading a device's battery and settings, along with a command
+STATS_USAGE = "Usage: /stats [today|Nd] [since=DD.MM[.YYYY]|Nh|Nd] [until=...] [device=NAME] [user=NAME]"
+DEFAULT_STATS_DAYS = 7
+TRANSITIONS = {"on": "ON", "force on": "ON", "scheduled on": "ON", "detected on": "ON",
+               "off": "OFF", "force off": "OFF", "scheduled off": "OFF", "detected off": "OFF", "automatic off": "OFF"}
+LOG_USAGE = "Usage: /log [page] [user=NAME] [action=ACTION] [device=NAME] [since=DD.MM[.YYYY]|Nh|Nd] [until=...]"
+
+
+_changes = dict()  # Device name -> the status it changed to, until add_to_log announces it
+_changes_lock = threading.Lock()
+
+
+def set_state(device_name, status):
+    """devices.set_state, remembering whether the status changed for the add_to_log that follows it."""
+    if devices.set_state(device_name, status) != status:
+        with _changes_lock:
+            _changes[device_name] = status
+
+
+def take_change(device_name, status):
+    """Whether device_name changed to status since it was last announced, announcing it only once."""
+    with _changes_lock:
+        if _changes.get(device_name) != status:
+            return False
+        del _changes[device_name]
+        return True
+
+
+def add_to_log(update, action, device=None):
     if update is None:
+        user_id = None
         name = "System"
     else:
-        user = update.message.from_user
+        user = update.effective_user
         user_id = str(user["id"])
         name = Configuration.Allowed[user_id]
 
-    current_time = datetime.datetime.now().strftime("%d.%m %H:%M")
-    LOG.append((name, current_time, action))
-    if len(LOG) >= LOG_SIZE:
-        LOG.pop(0)
+    now = time.time()
+    history.record(now, user_id, name, action, device)
+    if device is not None and action in TRANSITIONS:
+        history.record_transition(now, name, device, TRANSITIONS[action], automatic=action == "automatic off")
+        # Forcing a device that is already there, or callers coalesced into a single actuation, change nothing
+        if take_change(device, TRANSITIONS[action]):
+            notifications.notify(device, TRANSITIONS[action], name, action, user_id)
+            panel.refresh()
+    fields = {"user": name, "action": action, "device": device}
+    if device is None:
+        heatbot.logger.info(f"{name} used action '{action}'.", extra=fields)
+    else:
+        heatbot.logger.info(f"{name} used action '{action}' on '{device}'.", extra=fields)
 
-    heatbot.logger.info(f"{name} used action '{action}'.")
 
+async def add_to_log_async(update, action, device=None):
+    """add_to_log for handlers, keeping its disk writes off the event loop."""
+    await asyncio.to_thread(add_to_log, update, action, device)
 
-def get_log(is_master=False):
-    global LOG
 
-    log_output = "Logs:\n"
-    if len(LOG) == 0:
-        return log_output + "     None."
+def parse_time(value):
+    if value[-1:] in ("h", "d") and value[:-1].isdecimal():
+        hours = int(value[:-1]) * (24 if value[-1] == "d" else 1)
+        return time.time() - hours * 3600
 
-    for name, current_time, action in LOG:
+    for time_format in ("%d.%m.%Y", "%d.%m"):
+        try:
+            moment = datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        if time_format == "%d.%m":
+            moment = moment.replace(year=datetime.datetime.now().year)
+        return moment.timestamp()
+    raise ValueError(f"Invalid time: '{value}'")
+
+
+def parse_log_filters(args, is_master=False):
+    filters = dict()
+    for arg in args:
+        if arg.isdecimal():
+            filters["page"] = max(int(arg) - 1, 0)
+            continue
+
+        key, _, value = arg.partition("=")
+        if key == "user" and value:
+            if not is_master:
+                raise ValueError("Only the master can filter by user")  # Names are only ever shown to the master
+            filters["name"] = value
+        elif key == "action" and value:
+            filters["action"] = value.replace("_", " ")
+        elif key == "device" and value:
+            filters["device"] = value
+        elif key in ("since", "until") and value:
+            filters[key] = parse_time(value)
+        else:
+            raise ValueError(f"Unknown filter: '{arg}'")
+    return filters
+
+
+def get_log(is_master=False, **filters):
+    if filters:
+        entries = history.query(**filters)
+        entries.reverse()
+    else:
+        entries = history.recent()
+
+    if len(entries) == 0:
+        return "Logs:\n     None."
+
+    lines = ["Logs:"]
+    for entry in entries:
+        current_time = datetime.datetime.fromtimestamp(entry.timestamp).strftime("%d.%m %H:%M")
+        action = entry.action if entry.device is None else f"{entry.action} {entry.device}"
         if is_master:
-            log_output += "%10s : " % (name,)
-        log_output += f"{current_time} - {action}.\n"
-    return log_output[:-1]
+            lines.append("%10s : %s - %s." % (entry.name, current_time, action))
+        else:
+            lines.append(f"{current_time} - {action}.")
+    return "\n".join(lines)
 
 
-def get_status():
-    last_change = datetime.datetime.fromtimestamp(Configuration.LastChange)
-    last_change_duration = datetime.datetime.now() - last_change
+def get_duration_string(last_change):
+    last_change_duration = datetime.datetime.now() - datetime.datetime.fromtimestamp(last_change)
     hours = last_change_duration.seconds // 3600 + last_change_duration.days * 24
     minutes = (last_change_duration.seconds // 60) % 60
 
@@ -60,126 +163,451 @@ def get_status():
     elif hours == 1:
         duration_string += f"{hours} hour and "
     duration_string += f"{minutes} minutes"
+    return duration_string
+
+
+def get_advertised_string(device_name):
+    state = advertisements.get_state(devices.get_devices()[device_name].address)
+    if state is None:
+        info, _ = _device_info.get(device_name, (None, 0))
+        return f" Battery {info.battery}%." if info is not None else ""
+    return f" Battery {state.battery}%, seen {time.time() - state.last_seen:.0f} seconds ago."
+
+
+def get_status(device_names=None):
+    if device_names is None:
+        device_names = list(devices.get_devices())
+
+    if devices.is_single_device():
+        current_status, last_change = devices.get_state(device_names[0])
+        duration_string = get_duration_string(last_change)
+        if last_change == 0:
+            status_message = f"Current Status: {current_status}."  # Never changed since it was configured
+        elif current_status == "ON":
+            status_message = f"The heat has been ON for {duration_string}."
+        elif current_status == "OFF":
+            status_message = f"The heat has been OFF for {duration_string}."
+        else:
+            status_message = f"Current Status: UNKNOWN.\nLast status change: {duration_string} ago."
+        return status_message + get_advertised_string(device_names[0])
+
+    lines = list()
+    for name in device_names:
+        current_status, last_change = devices.get_state(name)
+        if last_change == 0:
+            lines.append(f"{name}: {current_status}." + get_advertised_string(name))
+        elif current_status == "UNKNOWN":
+            lines.append(f"{name}: UNKNOWN, last changed {get_duration_string(last_change)} ago."
+                         + get_advertised_string(name))
+        else:
+            lines.append(f"{name}: {current_status} for {get_duration_string(last_change)}."
+                         + get_advertised_string(name))
+    return "\n".join(lines)
+
+
+async def resolve_targets(update, context):
+    """Returns the device names the command targets, or None after telling the user they are unknown."""
+    try:
+        return devices.resolve(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}. Known devices: {', '.join(devices.get_devices())}.")
+        return None
+
+
+async def reply_status(update, device_names):
+    await update.message.reply_text(get_status(device_names))
+    await add_to_log_async(update, "status")
+    return ConversationHandler.END
 
-    if Configuration.CurrentStatus == "ON":
-        status_message = f"The heat has been ON for {duration_string}."
-    elif Configuration.CurrentStatus == "OFF":
-        status_message = f"The heat has been OFF for {duration_string}."
-    else:
-        status_message = f"Current Status: UNKNOWN.\nLast status change: {duration_string} ago."
-    return status_message
+
+@verifier.verify_id
+@verifier.rate_limit("query")
+async def status(update, context):
+    device_names = await resolve_targets(update, context)
+    if device_names is None:
+        return ConversationHandler.END
+    return await reply_status(update, device_names)
 
 
 @verifier.verify_id
-def status(update, context):
-    update.message.reply_text(get_status())
-    add_to_log(update, "status")
+@verifier.rate_limit("query")
+async def log(update, context):
+    user = update.message.from_user
+    is_master = str(user["id"]) == Configuration.MasterID
+
+    try:
+        filters = parse_log_filters(context.args or [], is_master)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n{LOG_USAGE}")
+        return ConversationHandler.END
+
+    await update.message.reply_text(await asyncio.to_thread(get_log, is_master, **filters))
+    await add_to_log_async(update, "log")
     return ConversationHandler.END
 
+
+def parse_stats_filters(args, is_master=False):
+    filters = {"since": time.time() - DEFAULT_STATS_DAYS * 24 * 3600, "until": time.time()}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if arg == "today":
+            filters["since"] = time.time()
+        elif not value and arg[:-1].isdecimal() and arg[-1:] == "d":
+            filters["since"] = parse_time(arg)
+        elif key == "user" and value:
+            if not is_master:
+                raise ValueError("Only the master can filter by user")  # Like the per-user breakdown
+            filters["name"] = value
+        elif key == "device" and value:
+            filters["device"] = value
+        elif key in ("since", "until") and value:
+            filters[key] = parse_time(value)
+        else:
+            raise ValueError(f"Unknown filter: '{arg}'")
+    return filters
+
+
+def get_hours_string(seconds):
+    return f"{int(seconds // 3600)}h {int(seconds // 60) % 60:02d}m"
+
+
+def get_usage_string(usages):
+    on_seconds = sum(usage.on_seconds for usage in usages)
+    usage_string = (f"{get_hours_string(on_seconds)} ON, {sum(usage.cycles for usage in usages)} cycles, "
+                    f"{sum(usage.automatic_offs for usage in usages)} automatic offs")
+    watts = [Configuration.PowerWatts.get(usage.device) for usage in usages]
+    if len(usages) > 0 and None not in watts:
+        kwh = sum(usage.on_seconds * device_watts for usage, device_watts in zip(usages, watts)) / 3600 / 1000
+        usage_string += f", ~{kwh:.1f} kWh"
+    return usage_string
+
+
+def get_stats(is_master, since, until, **filters):
+    usages = history.usage(since, until, **filters)
+    lines = [f"Usage {datetime.datetime.fromtimestamp(since):%d.%m} - {datetime.datetime.fromtimestamp(until):%d.%m}:",
+             f"Total: {get_usage_string(usages)}"]
+    breakdowns = [("device", lambda usage: usage.device)] if not devices.is_single_device() else []
+    if is_master:
+        breakdowns.append(("user", lambda usage: usage.name))
+
+    for title, key in breakdowns:
+        groups = dict()
+        for usage in usages:
+            groups.setdefault(key(usage), list()).append(usage)
+        if len(groups) > 1:
+            lines.append(f"By {title}:")
+            lines += [f"    {group}: {get_usage_string(group_usages)}"
+                      for group, group_usages in sorted(groups.items())]
+    return "\n".join(lines)
+
+
 @verifier.verify_id
-def log(update, context):
+@verifier.rate_limit("query")
+async def stats(update, context):
     user = update.message.from_user
-    user_id = str(user["id"])
+    is_master = str(user["id"]) == Configuration.MasterID
+
+    try:
+        filters = parse_stats_filters(context.args or [], is_master)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n{STATS_USAGE}")
+        return ConversationHandler.END
 
-    update.message.reply_text(get_log(user_id == Configuration.MasterID))
-    add_to_log(update, "log")
+    await update.message.reply_text(await asyncio.to_thread(get_stats, is_master, **filters))
+    await add_to_log_async(update, "stats")
     return ConversationHandler.END
 
 
-def turn_on():
-    switchbot_driver = switchbot_py3.Driver(Configuration.BluetoothAddress,
-                                            Configuration.BluetoothInterface)
-    return_code = switchbot_driver.run_command("on")
-    if return_code != [b'\x13']:
+_device_info = dict()  # Device name -> (last BasicInfo it answered with, when it was asked)
+
+
+def attempt_switchbot_command(command, device_name):
+    device = devices.get_devices()[device_name]
+    if bleworker.is_running():
+        switchbot_driver = bleworker.Driver(device.address, device.interface)
+    else:
+        switchbot_driver = switchbot_py3.Driver(device.address,
+                                                device.interface,
+                                                persistent=True,
+                                                registry=SWITCHBOT_REGISTRY)
+    # Reading the device's info rides along on the command's connection, rather than paying for one of its own
+    commands = [command]
+    if time.time() - _device_info.get(device_name, (None, 0))[1] > INFO_INTERVAL:
+        commands.append("info")
+    results = None
+    try:
+        with advertisements.paused():
+            results = switchbot_driver.run_commands(commands)
+    except ConnectionError as e:
+        heatbot.logger.warning(f"Switchbot command '{command}' on '{device_name}' failed: {e}")
+    finally:
+        heatbot.logger.info(f"Switchbot command '{command}' on '{device_name}' took "
+                            f"{switchbot_driver.connect_time:.3f}s to connect "
+                            f"and {switchbot_driver.write_time:.3f}s to write.",
+                            extra={"action": command, "device": device_name,
+                                   "latency": round(switchbot_driver.connect_time + switchbot_driver.write_time, 3)})
+        if switchbot_driver.connect_time > 0:
+            metrics.observe("ble_connect", switchbot_driver.connect_time)
+        if switchbot_driver.write_time > 0:
+            metrics.observe("ble_write", switchbot_driver.write_time)
+
+    success = results is not None and results[0].ok
+    if results is not None and not success:
+        heatbot.logger.warning(f"Switchbot command '{command}' on '{device_name}' was refused: {results[0]}")
+    # Only an answer counts, a device that didn't answer is asked again along with its next command
+    if results is not None and len(results) > 1 and results[1].info is not None:
+        _device_info[device_name] = (results[1].info, time.time())
+        heatbot.logger.info(f"Device '{device_name}' reports {results[1].info}.")
+    metrics.increment("ble_commands_total", device=device_name, result="success" if success else "failure")
+    return success
+
+
+def run_switchbot_command(command, device_name):
+    """
+    Runs the command with retries, behind the device's circuit breaker. While the breaker is open the command
+    fails right away, instead of every request waiting out the connection timeout of an unreachable device.
+    """
+    retry_settings = Configuration.Retry
+    breaker = retries.get_breaker(device_name,
+                                  retry_settings.get("BreakerThreshold", DEFAULT_BREAKER_THRESHOLD),
+                                  retry_settings.get("BreakerResetSeconds", DEFAULT_BREAKER_RESET_SECONDS))
+    if not breaker.allow():
+        heatbot.logger.warning(f"Switchbot command '{command}' on '{device_name}' rejected, it is unreachable.")
+        metrics.increment("ble_commands_total", device=device_name, result="rejected")
         return False
 
-    Configuration.CurrentStatus = "ON"
-    Configuration.LastChange = datetime.datetime.now().timestamp()
-    Configuration.save_configuration()
+    policy = retries.RetryPolicy(retry_settings.get("Attempts", DEFAULT_RETRY_ATTEMPTS),
+                                 retry_settings.get("BaseDelay", DEFAULT_RETRY_BASE_DELAY),
+                                 retry_settings.get("MaxDelay", DEFAULT_RETRY_MAX_DELAY))
+    # A half-open breaker only needs to know whether the device is back, a single attempt tells
+    attempts = 1 if breaker.is_probing() else None
+    try:
+        succeeded = policy.run(functools.partial(attempt_switchbot_command, command, device_name), attempts)
+    except Exception:
+        breaker.record_failure()  # Or a failed half-open probe would leave the breaker half-open for good
+        raise
+    if succeeded:
+        breaker.record_success()
+        return True
+
+    breaker.record_failure()
+    if breaker.state == retries.OPEN:
+        heatbot.logger.warning(f"Device '{device_name}' is unreachable, failing fast for "
+                               f"{breaker.reset_seconds} seconds.")
+    return False
+
+
+def turn_on(device_name):
+    if not run_switchbot_command("on", device_name):
+        return False
+
+    set_state(device_name, "ON")
+    arm_automatic_off(device_name)
     return True
 
 
-def turn_off():
-    switchbot_driver = switchbot_py3.Driver(Configuration.BluetoothAddress,
-                                            Configuration.BluetoothInterface)
-    return_code = switchbot_driver.run_command("off")
-    if return_code != [b'\x13']:
+def turn_off(device_name):
+    if not run_switchbot_command("off", device_name):
         return False
 
-    Configuration.CurrentStatus = "OFF"
-    Configuration.LastChange = datetime.datetime.now().timestamp()
-    Configuration.save_configuration()
+    set_state(device_name, "OFF")
+    arm_automatic_off(device_name)
     return True
 
 
-@verifier.verify_id
-def on(update, context):
-    if Configuration.CurrentStatus == "ON":
-        return status(update, context)
+def actuate(device_name, action, callback):
+    actuator.submit(device_name, action, callback, device_name,
+                    adapter=devices.get_devices()[device_name].interface)
 
-    if turn_on():
-        update.message.reply_text("Turned Heatbot ON 💡")
-        add_to_log(update, "on")
-    else:
-        update.message.reply_text("Failed to turn on...")
-    return ConversationHandler.END
 
+async def actuate_async(device_name, action):
+    """Awaits action(device_name) on the device's actuator lane, where the blocking BLE work runs."""
+    return await actuator.execute(device_name, action, device_name,
+                                  adapter=devices.get_devices()[device_name].interface)
 
-@verifier.verify_id
-def off(update, context):
-    if Configuration.CurrentStatus == "OFF":
-        return status(update, context)
 
-    if turn_off():
-        update.message.reply_text("Turned Heat OFF 🍗")
-        add_to_log(update, "off")
+async def reply_when_done(update, action, device_names, working_message, success_message, failure_message,
+                          log_action):
+    """
+    Replies with a single message, which is edited as each device reports its result on its own.
+    """
+    if devices.is_single_device():
+        lines = {name: working_message for name in device_names}
+        results = {name: (success_message, failure_message) for name in device_names}
     else:
-        update.message.reply_text("Failed to turn off...")
+        lines = {name: f"{name}: {working_message}" for name in device_names}
+        results = {name: (f"{name}: {success_message}", f"{name}: {failure_message}") for name in device_names}
+    start_time = time.perf_counter()
+    with metrics.span("reply"):
+        message = await update.message.reply_text("\n".join(lines.values()))
+    lock = asyncio.Lock()
+
+    async def run(device_name):
+        success = await actuate_async(device_name, action)
+        metrics.observe("actuation", time.perf_counter() - start_time)
+        async with lock:
+            lines[device_name] = results[device_name][0 if success else 1]
+            with metrics.span("reply"):
+                await message.edit_text("\n".join(lines.values()))
+        if success:
+            await add_to_log_async(update, log_action, device_name)
+
+    await asyncio.gather(*(run(name) for name in device_names))
+
+
+async def turn_devices(update, context, action, target_status, working_message, success_message, failure_message,
+                       log_action, already_message=None):
+    """
+    Turns the targeted devices to target_status. Devices already there are skipped, unless an already_message
+    is given, which forces them and is used as the working message when all of them are already there.
+    """
+    targets = await resolve_targets(update, context)
+    if targets is None:
+        return ConversationHandler.END
+
+    device_names = [name for name in targets if devices.get_state(name)[0] != target_status]
+    if already_message is not None:
+        if len(device_names) == 0:
+            working_message = already_message
+        device_names = targets
+    elif len(device_names) == 0:
+        return await reply_status(update, targets)
+
+    await reply_when_done(update, action, device_names, working_message, success_message, failure_message,
+                          log_action)
     return ConversationHandler.END
 
 
 @verifier.verify_id
-def force_on(update, context):
-    if Configuration.CurrentStatus == "ON":
-        update.message.reply_text("HeatBot is already ON 💡. Turning it ON anyways...")
+@verifier.rate_limit("actuation")
+async def on(update, context):
+    return await turn_devices(update, context, turn_on, "ON",
+                        "Turning the heat ON…", "Turned Heatbot ON 💡", "Failed to turn on...", "on")
 
-    if turn_on():
-        update.message.reply_text("Turned Heat ON 💡")
-        add_to_log(update, "force on")
-    else:
-        update.message.reply_text("Failed to turn on...")
-    return ConversationHandler.END
+
+@verifier.verify_id
+@verifier.rate_limit("actuation")
+async def off(update, context):
+    return await turn_devices(update, context, turn_off, "OFF",
+                        "Turning the heat OFF…", "Turned Heat OFF 🍗", "Failed to turn off...", "off")
+
+
+@verifier.verify_id
+@verifier.rate_limit("actuation")
+async def force_on(update, context):
+    return await turn_devices(update, context, turn_on, "ON",
+                        "Turning the heat ON…", "Turned Heat ON 💡", "Failed to turn on...", "force on",
+                        already_message="HeatBot is already ON 💡. Turning it ON anyways...")
 
 
 @verifier.verify_id
-def force_off(update, context):
-    if Configuration.CurrentStatus == "OFF":
-        update.message.reply_text("HeatBot is already OFF 🍗. Turning it OFF anyways...")
-    
-    if turn_off():
-        update.message.reply_text("Turned Heatbot OFF.")
-        add_to_log(update, "force off")
+@verifier.rate_limit("actuation")
+async def force_off(update, context):
+    return await turn_devices(update, context, turn_off, "OFF",
+                        "Turning the heat OFF…", "Turned Heatbot OFF.", "Failed to turn off...", "force off",
+                        already_message="HeatBot is already OFF 🍗. Turning it OFF anyways...")
+
+
+def arm_automatic_off(device_name):
+    """
+    Arms the device's automatic off timer to the exact moment it should turn off, or disarms it if it shouldn't.
+    Deadlines derive from the persisted LastChange, so calling this after a restart picks up where we left off.
+    """
+    timer_key = f"{AUTOMATIC_OFF_TIMER} {device_name}"
+    current_status, last_change = devices.get_state(device_name)
+    if current_status != "ON" or Configuration.AutomaticOffInMinutes is None:
+        scheduler.cancel(timer_key)
+        return
+
+    deadline = last_change + Configuration.AutomaticOffInMinutes * 60
+    scheduler.schedule(timer_key, deadline, functools.partial(automatic_off, device_name))
+
+
+def arm_all_automatic_offs():
+    for name in devices.get_devices():
+        arm_automatic_off(name)
+
+
+def automatic_off(device_name):
+    if devices.get_state(device_name)[0] != "ON":
+        return
+    actuate(device_name, turn_off, functools.partial(on_automatic_off, device_name))
+
+
+def on_automatic_off(device_name, success):
+    if success:
+        add_to_log(None, "automatic off", device_name)
     else:
-        update.message.reply_text("Failed to turn off...")
+        heatbot.logger.warning(f"Automatic off of '{device_name}' failed")
+        scheduler.schedule(f"{AUTOMATIC_OFF_TIMER} {device_name}", time.time() + AUTOMATIC_OFF_RETRY_SECONDS,
+                           functools.partial(automatic_off, device_name))
+
+
+_disagreements = dict()
+
+
+def reconcile(address, state):
+    """
+    Corrects a device's recorded state from its advertisements, e.g. after it was switched by hand.
+    The advertised state must disagree a few times in a row, and not while or right after we actuate the device,
+    since advertisements may lag behind our own writes.
+    """
+    names = [device.name for device in devices.get_devices().values() if device.address.lower() == address]
+    if len(names) == 0 or not state.switch_mode:
+        return
+    name = names[0]
+
+    advertised_status = "ON" if state.is_on else "OFF"
+    current_status, last_change = devices.get_state(name)
+    if advertised_status == current_status or actuator.is_busy(name) or \
+            time.time() - last_change < RECONCILE_GRACE_SECONDS:
+        _disagreements.pop(name, None)
+        return
+
+    _disagreements[name] = _disagreements.get(name, 0) + 1
+    if _disagreements[name] < RECONCILE_CONFIRMATIONS:
+        return
+
+    del _disagreements[name]
+    set_state(name, advertised_status)
+    arm_automatic_off(name)
+    add_to_log(None, f"detected {advertised_status.lower()}", name)
+
+
+def start_advertisement_listener():
+    settings = Configuration.Advertisements
+    if settings is None or not settings.get("Enabled", True):
+        return
+    interface = settings.get("Interface") or next(iter(devices.get_devices().values())).interface
+    try:
+        advertisements.start(interface, reconcile, active=settings.get("Active", True))
+    except (OSError, ImportError) as e:
+        heatbot.logger.error(f"Failed to listen to advertisements on {interface}: {e}")
+
+
+@verifier.verify_master
+@verifier.rate_limit("admin")
+async def show_metrics(update, context):
+    message = metrics.summary() or "No metrics were collected yet."
+    for name, breaker in sorted(retries.get_breakers().items()):
+        message += f"\n{name} circuit breaker: {breaker.state}, {breaker.failures} consecutive failures"
+    await update.message.reply_text(message)
     return ConversationHandler.END
 
-def async_automatic_off(should_stop_event):
-    while not should_stop_event.is_set():
-        for _ in range(AUTOMATIC_OFF_THREAD_INTERVALS // AUTOMATIC_OFF_THREAD_SLEEP):
-            time.sleep(AUTOMATIC_OFF_THREAD_SLEEP)
-            if should_stop_event.is_set():
-                return
-
-        if Configuration.CurrentStatus != "ON":
-            continue
-        if Configuration.AutomaticOffInMinutes is None:
-            continue
 
-        now = datetime.datetime.now()
-        last_change = datetime.datetime.fromtimestamp(Configuration.LastChange)
-        minutes_since_last_change = (now - last_change).total_seconds() / 60
-        if minutes_since_last_change >= Configuration.AutomaticOffInMinutes:
-            if turn_off():
-                add_to_log(None, "automatic off")
-            else:
-                heatbot.logger.warning("Automatic off failed")
+@verifier.verify_master
+@verifier.rate_limit("admin")
+async def timers(update, context):
+    pending_timers = scheduler.pending()
+    if len(pending_timers) == 0:
+        await update.message.reply_text("No pending timers.")
+        return ConversationHandler.END
+
+    now = time.time()
+    message = "Pending timers:"
+    for deadline, key in pending_timers:
+        fire_time = datetime.datetime.fromtimestamp(deadline).strftime("%d.%m %H:%M:%S")
+        minutes = max(deadline - now, 0) / 60
+        message += f"\n{fire_time} ({minutes:.1f} minutes) - {key}"
+    await update.message.reply_text(message)
+    return ConversationHandler.END
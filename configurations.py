@@ -1,33 +1,302 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
+import dataclasses
+import re
+import threading
+import types
+from typing import Mapping, Optional, Sequence
 
+import persistence
 
-class DynamicConfiguration:
-    def __init__(self, cls, args, _):
-        pass
+CONFIGURATION_WATCH_INTERVAL = 2  # Seconds
+STATUSES = ("ON", "OFF", "UNKNOWN")
+MOVED_KEYS = ("Schedules",)  # Kept in stores of their own now, taken out of older configuration files on load
 
-    @classmethod
-    def load_configuration(cls):
-        with open("configuration.json", "r") as conf:
-            cls.__configuration = json.loads(conf.read())
+_store = persistence.Store()
 
-    @classmethod
-    def save_configuration(cls):
-        with open("configuration.json", "w") as conf:
-            conf.write(json.dumps(cls.__configuration))
 
-    @classmethod
-    def __getattr__(cls, key):
-        if key not in cls.__configuration:
-            return None
-        return cls.__configuration[key]
+class ConfigurationError(ValueError):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    """
+    An immutable, validated snapshot of configuration.json. configuration.json.example shows every setting,
+    the comments here say what each one does.
+    """
+    TelegramAccessToken: str
+    MasterID: str  # The user ID of the master, who manages the allowed users
+    TelegramBaseUrl: Optional[str] = None  # Another Bot API server, Telegram's if unset
+    # Url Telegram pushes updates to, and the Listen address, Port and UrlPath it reaches the bot at behind the
+    # reverse proxy. Telegram sends SecretToken with every update, and the bot drops updates without it.
+    # The bot polls for updates if unset, or if the webhook can't be set up
+    Webhook: Optional[Mapping[str, object]] = None
+    BluetoothAddress: Optional[str] = None  # The Switchbot of a single-device setup
+    BluetoothInterface: Optional[str] = None  # E.g. "hci0", the system's default adapter if unset
+    # Name -> BluetoothAddress and optional BluetoothInterface of each Switchbot, instead of BluetoothAddress
+    Devices: Mapping[str, Mapping[str, str]] = dataclasses.field(default_factory=dict)
+    Groups: Mapping[str, Sequence[str]] = dataclasses.field(default_factory=dict)  # Name -> device names
+    DefaultTarget: Optional[str] = None  # The device or group commands without targets go to, "all" if unset
+    MaxConnectionsPerAdapter: int = 3  # Devices an adapter connects to at once
+    Allowed: Mapping[str, str] = dataclasses.field(default_factory=dict)  # User ID -> name
+    # Runtime state, kept up to date by the bot
+    CurrentStatus: str = "UNKNOWN"
+    LastChange: float = 0.0
+    DeviceStates: Mapping[str, Mapping[str, object]] = dataclasses.field(default_factory=dict)
+    AutomaticOffInMinutes: Optional[float] = None  # Turns the heat off after it's been on this long
+    # Tracks the devices' state from their advertisements, scanning on Interface (the first device's if unset),
+    # Active asks the devices for their scan responses
+    Advertisements: Optional[Mapping[str, object]] = None
+    # Runs Bluetooth commands in a supervised worker process unless Enabled is false, restarting it when
+    # a command takes more than DeadlineSeconds
+    BleWorker: Mapping[str, object] = dataclasses.field(default_factory=dict)
+    # Keeps conversations and user and chat data in bot_state.json unless Enabled is false, written every
+    # UpdateSeconds
+    BotState: Mapping[str, object] = dataclasses.field(default_factory=dict)
+    # Attempts per command, the BaseDelay and MaxDelay of their backoff in seconds, and the failures in a row
+    # (BreakerThreshold) that make a device fail fast for BreakerResetSeconds
+    Retry: Mapping[str, float] = dataclasses.field(default_factory=dict)
+    # Token bucket Rate per second and Burst of each user, per command class: actuation, query and admin
+    RateLimits: Mapping[str, Mapping[str, float]] = dataclasses.field(default_factory=dict)
+    # More words for the status, on, off and help intents of free text, on top of the built in ones
+    Intents: Mapping[str, Sequence[str]] = dataclasses.field(default_factory=dict)
+    # User IDs told whenever the heat is turned on or off, managed with /notify
+    Subscribers: Sequence[str] = dataclasses.field(default_factory=list)
+    # Device name -> the watts it draws while on, for the kWh estimate of /stats
+    PowerWatts: Mapping[str, float] = dataclasses.field(default_factory=dict)
+    # Format of the log file, text or json, rotated at MaxBytes or every RotateHours, keeping BackupCount
+    # old files, gzipped unless Compress is false
+    Logging: Mapping[str, object] = dataclasses.field(default_factory=dict)
+    MetricsPort: Optional[int] = None  # Serves the latency metrics for Prometheus on this port, off if unset
+    MetricsAddress: str = "127.0.0.1"
+
+    def __post_init__(self):
+        check_type("TelegramAccessToken", self.TelegramAccessToken, str)
+        check_type("MasterID", self.MasterID, str)
+        check_type("TelegramBaseUrl", self.TelegramBaseUrl, (str, type(None)))
+        check_type("Webhook", self.Webhook, (Mapping, type(None)))
+        if self.Webhook is not None:
+            check_type("Webhook.Url", self.Webhook.get("Url"), str)
+            check_type("Webhook.Listen", self.Webhook.get("Listen", ""), str)
+            check_type("Webhook.Port", self.Webhook.get("Port", 0), int)
+            check_type("Webhook.UrlPath", self.Webhook.get("UrlPath", ""), str)
+            secret_token = self.Webhook.get("SecretToken")
+            check_type("Webhook.SecretToken", secret_token, (str, type(None)))
+            if secret_token is not None and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", secret_token):
+                raise ConfigurationError("Webhook.SecretToken must be 1 to 256 characters of A-Z, a-z, 0-9, _ and -")
+        check_type("BluetoothAddress", self.BluetoothAddress, (str, type(None)))
+        check_type("BluetoothInterface", self.BluetoothInterface, (str, type(None)))
+        check_type("Devices", self.Devices, Mapping)
+        if len(self.Devices) == 0 and self.BluetoothAddress is None:
+            raise ConfigurationError("Either BluetoothAddress or Devices must be configured")
+        for name, device in self.Devices.items():
+            check_type(f"Devices.{name}", device, Mapping)
+            check_type(f"Devices.{name}.BluetoothAddress", device.get("BluetoothAddress"), str)
+            check_type(f"Devices.{name}.BluetoothInterface", device.get("BluetoothInterface"), (str, type(None)))
+        check_type("Groups", self.Groups, Mapping)
+        for name, members in self.Groups.items():
+            check_type(f"Groups.{name}", members, (list, tuple))
+            if len(self.Devices) > 0 and not set(members) <= set(self.Devices):
+                raise ConfigurationError(f"Group {name} has unknown devices: {sorted(set(members) - set(self.Devices))}")
+        check_type("DefaultTarget", self.DefaultTarget, (str, type(None)))
+        check_type("MaxConnectionsPerAdapter", self.MaxConnectionsPerAdapter, int)
+        check_type("Allowed", self.Allowed, Mapping)
+        for user_id, name in self.Allowed.items():
+            if not isinstance(user_id, str) or not user_id.isdecimal() or not isinstance(name, str):
+                raise ConfigurationError(f"Invalid allowed user: {user_id!r} - {name!r}")
+        if self.CurrentStatus not in STATUSES:
+            raise ConfigurationError(f"CurrentStatus must be one of {STATUSES}, got {self.CurrentStatus!r}")
+        check_type("LastChange", self.LastChange, (int, float))
+        check_type("DeviceStates", self.DeviceStates, Mapping)
+        for name, state in self.DeviceStates.items():
+            if state.get("CurrentStatus") not in STATUSES:
+                raise ConfigurationError(f"Invalid status for device {name}: {state.get('CurrentStatus')!r}")
+            check_type(f"DeviceStates.{name}.LastChange", state.get("LastChange"), (int, float))
+        check_type("AutomaticOffInMinutes", self.AutomaticOffInMinutes, (int, float, type(None)))
+        check_type("Advertisements", self.Advertisements, (Mapping, type(None)))
+        if self.Advertisements is not None:
+            check_type("Advertisements.Interface", self.Advertisements.get("Interface", ""), (str, type(None)))
+        check_type("BleWorker", self.BleWorker, Mapping)
+        if not isinstance(self.BleWorker.get("Enabled", True), bool):
+            raise ConfigurationError(f"Invalid value for BleWorker.Enabled: {self.BleWorker['Enabled']!r}")
+        check_type("BleWorker.DeadlineSeconds", self.BleWorker.get("DeadlineSeconds", 0), (int, float))
+        check_type("BotState", self.BotState, Mapping)
+        if not isinstance(self.BotState.get("Enabled", True), bool):
+            raise ConfigurationError(f"Invalid value for BotState.Enabled: {self.BotState['Enabled']!r}")
+        check_type("BotState.UpdateSeconds", self.BotState.get("UpdateSeconds", 1), (int, float))
+        check_type("Retry", self.Retry, Mapping)
+        for key, value in self.Retry.items():
+            if key not in ("Attempts", "BaseDelay", "MaxDelay", "BreakerThreshold", "BreakerResetSeconds"):
+                raise ConfigurationError(f"Unknown retry setting: {key}")
+            check_type(f"Retry.{key}", value, int if key in ("Attempts", "BreakerThreshold") else (int, float))
+        if self.Retry.get("Attempts", 1) < 1:
+            raise ConfigurationError(f"Retry.Attempts must be at least 1, got {self.Retry['Attempts']!r}")
+        check_type("RateLimits", self.RateLimits, Mapping)
+        for command_class, limits in self.RateLimits.items():
+            if command_class not in ("actuation", "query", "admin"):
+                raise ConfigurationError(f"Unknown rate limit class: {command_class}")
+            check_type(f"RateLimits.{command_class}.Rate", limits.get("Rate", 0), (int, float))
+            check_type(f"RateLimits.{command_class}.Burst", limits.get("Burst", 0), (int, float))
+        check_type("Intents", self.Intents, Mapping)
+        for intent, aliases in self.Intents.items():
+            if intent not in ("status", "on", "off", "help"):
+                raise ConfigurationError(f"Unknown intent: {intent}")
+            check_type(f"Intents.{intent}", aliases, (list, tuple))
+        check_type("Subscribers", self.Subscribers, (list, tuple))
+        for user_id in self.Subscribers:
+            if not isinstance(user_id, str) or not user_id.isdecimal():
+                raise ConfigurationError(f"Invalid subscriber: {user_id!r}")
+        check_type("PowerWatts", self.PowerWatts, Mapping)
+        for name, watts in self.PowerWatts.items():
+            check_type(f"PowerWatts.{name}", watts, (int, float))
+        check_type("Logging", self.Logging, Mapping)
+        for key, value in self.Logging.items():
+            if key not in ("Format", "MaxBytes", "BackupCount", "RotateHours", "Compress"):
+                raise ConfigurationError(f"Unknown logging setting: {key}")
+        if self.Logging.get("Format", "text") not in ("text", "json"):
+            raise ConfigurationError(f"Logging.Format must be 'text' or 'json', got {self.Logging['Format']!r}")
+        check_type("Logging.MaxBytes", self.Logging.get("MaxBytes", 0), int)
+        check_type("Logging.BackupCount", self.Logging.get("BackupCount", 0), int)
+        check_type("Logging.RotateHours", self.Logging.get("RotateHours"), (int, float, type(None)))
+        if not isinstance(self.Logging.get("Compress", True), bool):
+            raise ConfigurationError(f"Invalid value for Logging.Compress: {self.Logging['Compress']!r}")
+        check_type("MetricsPort", self.MetricsPort, (int, type(None)))
+        check_type("MetricsAddress", self.MetricsAddress, str)
+
+        # Nested containers are frozen as well, so a snapshot can be shared between threads as is
+        for field in dataclasses.fields(self):
+            object.__setattr__(self, field.name, freeze(getattr(self, field.name)))
 
     @classmethod
-    def __setattr__(cls, key, value):
-        cls.__configuration[key] = value
+    def from_dict(cls, data):
+        names = {field.name for field in dataclasses.fields(cls)}
+        unknown = set(data) - names
+        if unknown:
+            raise ConfigurationError(f"Unknown configuration keys: {', '.join(sorted(unknown))}")
+        try:
+            return cls(**data)
+        except TypeError as e:
+            raise ConfigurationError(str(e))
+
+    def to_dict(self):
+        data = dict()
+        for field in dataclasses.fields(self):
+            value = thaw(getattr(self, field.name))
+            default = field.default_factory() if field.default_factory is not dataclasses.MISSING else field.default
+            # Unset optional settings are left out, so the file only holds what was actually configured
+            if value != default or field.name in persistence.HOT_KEYS:
+                data[field.name] = value
+        return data
+
+
+def check_type(name, value, expected_types):
+    if isinstance(value, bool) or not isinstance(value, expected_types):
+        raise ConfigurationError(f"Invalid value for {name}: {value!r}")
+
+
+def freeze(value):
+    if isinstance(value, Mapping):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class DynamicConfiguration:
+    """
+    Publishes the fields of the current Settings snapshot as plain attributes, so reads cost a single lookup.
+    Assignments build a new snapshot and swap it in. Readers that need several fields to be consistent with
+    each other should read them off Configuration.snapshot.
+    """
+
+    def __init__(self):
+        self.__dict__["_lock"] = threading.RLock()
+        self.__dict__["snapshot"] = None
+        self.__dict__["_watch_stop"] = None
+        self.__dict__["_moved"] = dict()
+
+    def _publish(self, snapshot):
+        self.__dict__.update({field.name: getattr(snapshot, field.name) for field in dataclasses.fields(snapshot)})
+        self.__dict__["snapshot"] = snapshot
+
+    def load_configuration(self):
+        with self._lock:
+            data = dict(_store.load())
+            self._moved.update((key, data.pop(key)) for key in MOVED_KEYS if key in data)
+            self._publish(Settings.from_dict(data))
+
+    def take_moved(self, key):
+        """Returns the value of a moved key found in the configuration file, once, for its new store to import."""
+        with self._lock:
+            return self._moved.pop(key, None)
+
+    def reload_configuration(self):
+        """Loads settings changed on disk, keeping the runtime state this process owns."""
+        with self._lock:
+            on_disk, journal_entries = _store.read()
+            data = {key: value for key, value in on_disk.items() if key not in MOVED_KEYS}
+            for key in persistence.HOT_KEYS:
+                data[key] = getattr(self.snapshot, key)
+            snapshot = Settings.from_dict(data)
+
+            _store.adopt(on_disk, journal_entries)
+            self._publish(snapshot)
+            _store.save(snapshot.to_dict())
+
+    def update(self, **changes):
+        with self._lock:
+            self._publish(dataclasses.replace(self.snapshot, **changes))
+
+    def transform(self, function):
+        """Atomically applies the changes function(snapshot) returns, for read-modify-write updates."""
+        with self._lock:
+            self._publish(dataclasses.replace(self.snapshot, **function(self.snapshot)))
+
+    def __setattr__(self, key, value):
+        self.update(**{key: value})
+
+    def save_configuration(self):
+        _store.save(self.snapshot.to_dict())  # Only marks it pending, the write is timed in Store.flush
+
+    def flush_configuration(self):
+        _store.flush()
+
+    def watch_configuration(self, logger, on_reload=None, interval=CONFIGURATION_WATCH_INTERVAL):
+        if self._watch_stop is not None:
+            return
+        stop_event = threading.Event()
+        self.__dict__["_watch_stop"] = stop_event
+
+        def watch():
+            while not stop_event.wait(interval):
+                try:
+                    if not _store.modified_externally():
+                        continue
+                    self.reload_configuration()
+                    logger.info("Reloaded configuration from disk.")
+                    if on_reload is not None:
+                        on_reload()
+                except (OSError, ValueError) as e:
+                    # Keep serving the last good snapshot until the file is fixed
+                    _store.acknowledge_modification()
+                    logger.error(f"Failed to reload configuration: {e}")
+
+        threading.Thread(target=watch, name="configuration-watcher", daemon=True).start()
+
+    def stop_watching_configuration(self):
+        if self._watch_stop is not None:
+            self._watch_stop.set()
+            self.__dict__["_watch_stop"] = None
 
 
-class Configuration(metaclass=DynamicConfiguration):
-    __configuration = None
+Configuration = DynamicConfiguration()
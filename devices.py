@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import time
+
+from configurations import Configuration
+
+DEFAULT_DEVICE = "heater"
+ALL_DEVICES = "all"
+
+Device = collections.namedtuple("Device", ["name", "address", "interface"])
+
+_devices_cache = (None, None)
+
+
+def get_devices():
+    """Returns the configured devices by name. A legacy single-device configuration yields one DEFAULT_DEVICE."""
+    global _devices_cache
+
+    snapshot = Configuration.snapshot
+    cached_snapshot, cached_devices = _devices_cache
+    if cached_snapshot is snapshot:
+        return cached_devices
+
+    if len(snapshot.Devices) > 0:
+        devices = {name: Device(name, device["BluetoothAddress"],
+                                device.get("BluetoothInterface", snapshot.BluetoothInterface))
+                   for name, device in snapshot.Devices.items()}
+    else:
+        devices = {DEFAULT_DEVICE: Device(DEFAULT_DEVICE, snapshot.BluetoothAddress, snapshot.BluetoothInterface)}
+    _devices_cache = (snapshot, devices)
+    return devices
+
+
+def is_single_device():
+    return len(get_devices()) == 1
+
+
+def resolve(targets):
+    """
+    Resolves device and group names to a list of device names, in configuration order.
+    No targets means the DefaultTarget, or all devices.
+    """
+    devices = get_devices()
+    if not targets:
+        targets = [Configuration.DefaultTarget or ALL_DEVICES]
+
+    names = set()
+    for target in targets:
+        if target == ALL_DEVICES:
+            names.update(devices)
+        elif target in Configuration.Groups:
+            names.update(Configuration.Groups[target])
+        elif target in devices:
+            names.add(target)
+        else:
+            raise ValueError(f"Unknown device or group: '{target}'")
+    return [name for name in devices if name in names]
+
+
+def get_targets():
+    """Returns all the names resolve() accepts."""
+    return list(get_devices()) + list(Configuration.Groups) + [ALL_DEVICES]
+
+
+def get_state(name):
+    """Returns the (status, last change) of a device."""
+    state = Configuration.DeviceStates.get(name)
+    if state is not None:
+        return state["CurrentStatus"], state["LastChange"]
+    if name == DEFAULT_DEVICE and len(Configuration.Devices) == 0:
+        # Configurations from before per-device states were tracked
+        return Configuration.CurrentStatus, Configuration.LastChange
+    return "UNKNOWN", 0.0
+
+
+def set_state(name, status):
+    """Records the status of a device, returning the one it had before."""
+    now = time.time()
+    previous = list()
+
+    def change(snapshot):
+        states = dict(snapshot.DeviceStates)
+        previous.append(get_state(name)[0])  # Under the lock of transform, so no other change slips in between
+        states[name] = {"CurrentStatus": status, "LastChange": now}
+        statuses = set(state["CurrentStatus"] for state in states.values())
+        if "ON" in statuses:
+            overall_status = "ON"
+        elif statuses == {"OFF"} and len(states) >= len(get_devices()):
+            overall_status = "OFF"
+        else:
+            overall_status = "UNKNOWN"
+        return {"DeviceStates": states, "CurrentStatus": overall_status, "LastChange": now}
+
+    Configuration.transform(change)
+    Configuration.save_configuration()
+    return previous[-1]
@@ -1,23 +1,49 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
+import hashlib
+import json
 import logging
-import threading
+import signal
+import socket
+import time
+from contextlib import contextmanager
 
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackQueryHandler
-from telegram import BotCommand, KeyboardButton, ReplyKeyboardMarkup
+IMPORT_START_TIME = time.perf_counter()
+
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler
+from telegram import BotCommand, ReplyKeyboardRemove, Update
+from telegram.error import TelegramError
 
 from configurations import Configuration
 import verifier
 import users
 import commands
+import actuator
+import advertisements
+import bleworker
+import devices
+import history
+import intents
+import logs
+import metrics
+import notifications
+import panel
+import persistence
+import scheduler
+import schedules
+import switchbot_py3
 
 AVAILABLE_COMMANDS = """The available commands are:
-/start         - Starts interaction with HeatBot.
-/status      - Shows the status of the HeatBot.
-/log             - Shows log of recent commands.
-/on             - Turns the heat on.
-/off             - Turns the heat off."""
+/start         - Shows the control panel, with buttons to turn the heat on and off.
+/status      - Shows the status of the HeatBot. Accepts device and group names.
+/log             - Shows log of recent commands. Accepts a page, user=, action=, device=, since= and until=.
+/on             - Turns the heat on. Accepts device and group names.
+/off             - Turns the heat off. Accepts device and group names.
+/notify        - Turns notifications of the heat turning on and off, by anyone, on or off.
+/stats         - Shows usage statistics. Accepts today, Nd, since=, until=, device= and user=.
+/schedule   - Lists, adds or removes timed programs, like '/schedule on 06:30 weekdays for 45'."""
 LAST_COMMANDS = """
 /force_on  - Turns the heat on, regardless of it's current status. Shouldn't be used unless something is wrong...
 /force_off - Turns the heat off, regardless of it's current status. Shouldn't be used unless something is wrong...
@@ -27,7 +53,9 @@ MASTER_COMMANDS = """
 /abort        - Aborts the current operation.
 /add           - Adds a new user to the HeatBot.
 /remove    - Removes a user from the HeatBot.
-/list            - Lists all the users."""
+/list            - Lists all the users.
+/timers       - Lists the pending timers.
+/metrics     - Shows latency percentiles and failure counters."""
 
 # Enable logging
 LOG_FILE = "heatbot.log"
@@ -44,47 +72,52 @@ Line Highlights:
 "^\s*CRITICAL\s*$" action="HIGHLIGHT_LINE" fg="-65536" bold="true" italic="true" stripe="true"
 """
 FORMATTER = logging.Formatter("[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s")
-LOG_HANDLER = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=1024 * 1024 * 1024, backupCount=5)
-LOG_HANDLER.setFormatter(FORMATTER)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-logger.addHandler(LOG_HANDLER)
+logger.addHandler(logs.QUEUE_HANDLER)
+logs.start(LOG_FILE, FORMATTER)
 
 ID, ADD, REMOVE_ID = range(3)
+DEFAULT_WEBHOOK_PORT = 8443
+BOT_COMMANDS_HASH_FILE = "bot_commands.hash"
+
+_startup_times = list()
 
 
-def abort(update, context):
+async def abort(update, context):
     if "name_to_add" in context.user_data:
         del context.user_data["name_to_add"]
-    update.message.reply_text("Operation aborted.")
+    await update.message.reply_text("Operation aborted.")
     return ConversationHandler.END
 
 
 @verifier.verify_id
-def start(update, context):
-    keyboard = [[KeyboardButton("Help 🤷‍♂️"), KeyboardButton("Status ❔")],
-                [KeyboardButton("ON 💡"), KeyboardButton("OFF 🍗")]]
-    markup = ReplyKeyboardMarkup(keyboard)
-    update.message.reply_text("Hi! I'm your HeatBot!\nI'm here to help you turn your heater on and off :)",
-                              reply_markup=markup)
+@verifier.rate_limit("query")
+async def start(update, context):
+    # The control panel replaces the reply keyboard of older versions, whose every tap was a new message
+    await update.message.reply_text("Hi! I'm your HeatBot!\nI'm here to help you turn your heater on and off :)",
+                                    reply_markup=ReplyKeyboardRemove())
+    await panel.send(update, context)
     return ConversationHandler.END
 
 
 @verifier.verify_id
-def default(update, context):
+@verifier.rate_limit("query")
+async def default(update, context):
     """Answer an unknown message"""
-    update.message.reply_text("I didn't understand you. type /help for commands...")
+    await update.message.reply_text("I didn't understand you. type /help for commands...")
 
 
-def error(update, context):
+async def error(update, context):
     """Log Errors caused by Updates."""
     logger.error(f"reason '{context.error}'. Update {update}")
-    if update.message:
-        update.message.reply_text("An unknown error has occurred...")
+    if isinstance(update, Update) and update.message:
+        await update.message.reply_text("An unknown error has occurred...")
 
 
 @verifier.verify_id
-def help(update, context):
+@verifier.rate_limit("query")
+async def help(update, context):
     help_message = AVAILABLE_COMMANDS
 
     user = update.message.from_user
@@ -93,16 +126,178 @@ def help(update, context):
         help_message += MASTER_COMMANDS
 
     help_message += LAST_COMMANDS
-    update.message.reply_text(help_message)
+    await update.message.reply_text(help_message)
+
+
+def can_listen(address, port):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.bind((address, port))
+        return True
+    except OSError:
+        return False
+
+
+async def start_receiving_updates(updater):
+    """
+    Receives updates through the configured webhook, falling back to long polling if there is none,
+    or it can't be started.
+    """
+    webhook = Configuration.Webhook
+    if webhook is not None:
+        listen = webhook.get("Listen", "127.0.0.1")
+        port = webhook.get("Port", DEFAULT_WEBHOOK_PORT)
+        url_path = webhook.get("UrlPath", "")
+        if not can_listen(listen, port):
+            logger.error(f"Can't listen for webhook updates on {listen}:{port}, falling back to polling.")
+        else:
+            try:
+                await updater.start_webhook(listen=listen, port=port, url_path=url_path, webhook_url=webhook["Url"],
+                                            secret_token=webhook.get("SecretToken"))
+                # Only trusted once Telegram itself reports the webhook, however setting it went
+                info = await updater.bot.get_webhook_info()
+                if info.url == webhook["Url"]:
+                    logger.info(f"Receiving updates through the webhook on {listen}:{port}/{url_path}.")
+                    return
+                registered = f"'{info.url}'" if info.url else "no webhook"
+                logger.error(f"Telegram has {registered} registered instead of the configured webhook, "
+                             f"falling back to polling.")
+            except TelegramError as e:
+                logger.error(f"Failed to set the webhook, falling back to polling: {e}")
+            if updater.running:
+                await updater.stop()  # Stops the webhook's receiver, polling can't start next to it
+
+    # start_polling() deletes any webhook that is still registered, so updates can't end up in both places
+    await updater.start_polling()
+    logger.info("Receiving updates through polling.")
+
+
+async def set_bot_commands(bot, bot_commands):
+    """
+    Sets the commands for auto-completion, unless the same commands were already set for this bot.
+    A hash of what was last set is kept in BOT_COMMANDS_HASH_FILE, saving the request on most restarts.
+    """
+    bot_id = Configuration.TelegramAccessToken.split(":")[0]
+    described = [bot_id, Configuration.TelegramBaseUrl, [bot_command.to_dict() for bot_command in bot_commands]]
+    digest = hashlib.sha256(json.dumps(described).encode()).hexdigest()
+    try:
+        with open(BOT_COMMANDS_HASH_FILE, "r") as hash_file:
+            if hash_file.read().strip() == digest:
+                logger.info("Bot commands are unchanged, not setting them.")
+                return
+    except OSError:
+        pass
+
+    try:
+        await bot.set_my_commands(bot_commands)
+    except TelegramError as e:
+        logger.error(f"Failed to set the bot commands: {e}")
+        return
+    await asyncio.to_thread(persistence.atomic_write, BOT_COMMANDS_HASH_FILE, digest)
+
+
+@contextmanager
+def startup_phase(phase):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        _startup_times.append((phase, time.perf_counter() - start_time))
+
+
+def report_startup(ready_time):
+    phases = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in _startup_times)
+    logger.info(f"Answering updates {ready_time:.3f}s after starting, "
+                f"{time.perf_counter() - IMPORT_START_TIME:.3f}s in total ({phases}).")
+    metrics.observe("startup", ready_time)
+
+
+def arm_all_timers():
+    commands.arm_all_automatic_offs()
+    schedules.arm_all()
+
+
+async def run(application):
+    """Answers updates until the process receives SIGINT, SIGTERM or SIGABRT, then stops gracefully."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        loop.add_signal_handler(signal_number, stop_event.set)
+
+    async with application:
+        notifications.start(application.bot)
+        panel.start(application)
+        await application.start()
+
+        # Start the Bot
+        logger.info("Starting Heatbot...")
+        with startup_phase("receiving updates"):
+            await start_receiving_updates(application.updater)
+        ready_time = time.perf_counter() - IMPORT_START_TIME
+        logger.info("Heatbot started!")
+
+        # Everything below runs while updates are already being answered
+        # Start the timers, re-arming the automatic off and the schedules from the persisted state
+        with startup_phase("timers"):
+            scheduler.start()
+            arm_all_timers()
+
+        # Keep the device states fresh from their advertisements, without connecting to them
+        with startup_phase("advertisements"):
+            commands.start_advertisement_listener()
+
+        # Configure bot commands (for auto-completion)
+        bot_commands = [BotCommand(command="start", description="Starts interaction with HeatBot."),
+                        BotCommand(command="on", description="Turns the heat on."),
+                        BotCommand(command="off", description="Turns the heat off."),
+                        BotCommand(command="status", description="Shows the status of the HeatBot."),
+                        BotCommand(command="log", description="Shows the log of recent commands."),
+                        BotCommand(command="notify", description="Turns state change notifications on or off."),
+                        BotCommand(command="stats", description="Shows heating usage statistics."),
+                        BotCommand(command="schedule", description="Lists, adds or removes timed programs."),
+                        BotCommand(command="help", description="Shows a list of all commands.")]
+        with startup_phase("bot commands"):
+            await set_bot_commands(application.bot, bot_commands)
+        report_startup(ready_time)
+
+        await stop_event.wait()
+
+        await application.updater.stop()
+        advertisements.stop()
+        # Actuations still in flight report back to this loop, and may notify users, so it outlives them
+        await asyncio.to_thread(scheduler.stop, commands.SHUTDOWN_TIMEOUT)
+        await asyncio.to_thread(actuator.stop, commands.SHUTDOWN_TIMEOUT)
+        await notifications.stop()
+        panel.stop()
+        await application.stop()
 
 
 def main():
-    Configuration.load_configuration()
+    _startup_times.append(("imports", time.perf_counter() - IMPORT_START_TIME))
+    with startup_phase("configuration"):
+        Configuration.load_configuration()
+        logs.start(LOG_FILE, FORMATTER, Configuration.Logging)
+        Configuration.watch_configuration(logger, on_reload=arm_all_timers)
+    with startup_phase("history"):
+        history.open_history()
+        schedules.import_schedules()
+    if Configuration.MetricsPort is not None:
+        with startup_phase("metrics"):
+            metrics.start_server(Configuration.MetricsPort, Configuration.MetricsAddress)
 
     """Start the bot."""
-    updater = Updater(Configuration.TelegramAccessToken, use_context=True)
-    dp = updater.dispatcher
-    word_regex = lambda word: Filters.regex(f"^(.*\s+)?{word}(\s+.*)?$")
+    # Updates are handled concurrently as coroutines, BLE and disk work is awaited from the actuator's threads
+    builder = Application.builder().token(Configuration.TelegramAccessToken).concurrent_updates(True)
+    if Configuration.TelegramBaseUrl is not None:
+        builder = builder.base_url(Configuration.TelegramBaseUrl)
+    if Configuration.BotState.get("Enabled", True):
+        # Conversations and user data survive restarts, written in batches rather than on every update
+        builder = builder.persistence(persistence.BotPersistence(
+            update_interval=Configuration.BotState.get("UpdateSeconds", persistence.BOT_STATE_UPDATE_SECONDS)))
+    application = builder.build()
+    router = intents.Router({"status": commands.status, "on": commands.on, "off": commands.off, "help": help},
+                            default, devices.get_targets)
 
     # Configure conversations
     conversation_handler = ConversationHandler(
@@ -110,60 +305,65 @@ def main():
                       CommandHandler("remove", users.remove_id),
                       CommandHandler("list", users.list_users),
                       CommandHandler("status", commands.status),
-                      MessageHandler(word_regex("[sS]tatus"), commands.status),
                       CommandHandler("log", commands.log),
                       CommandHandler("on", commands.on),
-                      MessageHandler(word_regex("[oO][nN]"), commands.on),
                       CommandHandler("off", commands.off),
-                      MessageHandler(word_regex("[oO][fF][fF]"), commands.off),
                       CommandHandler("force_on", commands.force_on),
                       CommandHandler("force_off", commands.force_off),
                       CommandHandler("help", help),
-                      MessageHandler(word_regex("[hH]elp"), help),
                       CommandHandler("start", start),
-                      CommandHandler('abort', abort)],
+                      CommandHandler("stats", commands.stats),
+                      CommandHandler("notify", notifications.subscribe),
+                      CommandHandler("schedule", schedules.schedule),
+                      CommandHandler("timers", commands.timers),
+                      CommandHandler("metrics", commands.show_metrics),
+                      CommandHandler('abort', abort),
+                      MessageHandler(filters.TEXT & ~filters.COMMAND, router)],
         states={
-            ID: [MessageHandler(Filters.text, users.get_id)],
-            ADD: [MessageHandler(Filters.text, users.add_user)],
-            REMOVE_ID: [MessageHandler(Filters.text, users.remove)],
+            ID: [MessageHandler(filters.TEXT, users.get_id)],
+            ADD: [MessageHandler(filters.TEXT, users.add_user)],
+            REMOVE_ID: [MessageHandler(filters.TEXT, users.remove)],
         },
         fallbacks=[CommandHandler('abort', abort)],
+        name="conversation",
+        persistent=Configuration.BotState.get("Enabled", True),
     )
-    dp.add_handler(conversation_handler)
+    application.add_handler(conversation_handler)
+
+    # Buttons of the control panel
+    application.add_handler(CallbackQueryHandler(panel.button, pattern=f"^{panel.CALLBACK_PREFIX}:"))
 
     # Handler for non-commands
-    dp.add_handler(MessageHandler(Filters.text, default))
+    application.add_handler(MessageHandler(filters.TEXT, default))
 
     # Log errors
-    dp.add_error_handler(error)
-
-    # Configure bot commands (for auto-completion)
-    bot_commands = [BotCommand(command="start", description="Starts interaction with HeatBot."),
-                    BotCommand(command="on", description="Turns the heat on."),
-                    BotCommand(command="off", description="Turns the heat off."),
-                    BotCommand(command="status", description="Shows the status of the HeatBot."),
-                    BotCommand(command="log", description="Shows the log of recent commands."),
-                    BotCommand(command="help", description="Shows a list of all commands.")]
-    updater.bot.set_my_commands(bot_commands)
-
-    # Start the Bot
-    logger.info("Starting Heatbot...")
-    updater.start_polling()
-    logger.info("Heatbot started!")
-
-    # Starting automatic off thread
-    should_stop_event = threading.Event()
-    automatic_off_thread = threading.Thread(target=commands.async_automatic_off, args=(should_stop_event,))
-    automatic_off_thread.start()
-
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
-
-    should_stop_event.set()
-    automatic_off_thread.join(commands.AUTOMATIC_OFF_THREAD_SLEEP * 2)  # Wait 10 seconds for the thread to stop
-    logger.info("Heatbot stopped!")
+    application.add_error_handler(error)
+
+    # Start the actuator before the first update can reach it
+    actuator.start(max(len(devices.get_devices()), actuator.DEFAULT_WORKERS))
+    if Configuration.BleWorker.get("Enabled", True):
+        # A hung BLE stack is then killed and restarted on its own, without taking the bot down with it
+        with startup_phase("ble worker"):
+            bleworker.start()
+
+    try:
+        asyncio.run(run(application))
+    finally:
+        # Each step runs even when an earlier one raised, so pending configuration and history always reach disk
+        try:
+            bleworker.stop()
+            switchbot_py3.close_connections()
+            Configuration.stop_watching_configuration()
+        finally:
+            try:
+                Configuration.flush_configuration()
+            finally:
+                try:
+                    history.close_history()
+                finally:
+                    metrics.stop_server()
+                    logger.info("Heatbot stopped!")
+                    logs.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+HISTORY_FILE = "history.db"
+RECENT_SIZE = 15
+PAGE_SIZE = 15
+
+Entry = collections.namedtuple("Entry", ["timestamp", "user_id", "name", "action", "device"])
+Usage = collections.namedtuple("Usage", ["device", "name", "on_seconds", "cycles", "automatic_offs"])
+
+_recent = collections.deque(maxlen=RECENT_SIZE)
+_sessions = dict()  # Device -> (turned on at, name), while it is ON
+_lock = threading.Lock()
+_connection = None
+
+
+def open_history(path=HISTORY_FILE):
+    global _connection
+
+    with _lock:
+        _connection = sqlite3.connect(path, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.executescript("""
+            CREATE TABLE IF NOT EXISTS actions (
+                id INTEGER PRIMARY KEY,
+                timestamp REAL NOT NULL,
+                user_id TEXT,
+                name TEXT NOT NULL COLLATE NOCASE,
+                action TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS actions_by_timestamp ON actions (timestamp);
+            CREATE INDEX IF NOT EXISTS actions_by_name ON actions (name, timestamp);
+            CREATE INDEX IF NOT EXISTS actions_by_action ON actions (action, timestamp);
+        """)
+        columns = [row[1] for row in _connection.execute("PRAGMA table_info(actions)")]
+        if "device" not in columns:
+            _connection.execute("ALTER TABLE actions ADD COLUMN device TEXT")
+        _connection.execute("CREATE INDEX IF NOT EXISTS actions_by_device ON actions (device, timestamp)")
+        rows = _connection.execute("SELECT timestamp, user_id, name, action, device FROM actions "
+                                   "ORDER BY timestamp DESC LIMIT ?", (RECENT_SIZE,)).fetchall()
+        _recent.clear()
+        _recent.extend(Entry(*row) for row in reversed(rows))
+
+        # Usage is rolled up per day as it happens, so statistics never scan the actions themselves
+        _connection.executescript("""
+            CREATE TABLE IF NOT EXISTS daily_usage (
+                day TEXT NOT NULL,
+                device TEXT NOT NULL,
+                name TEXT NOT NULL COLLATE NOCASE,
+                on_seconds REAL NOT NULL DEFAULT 0,
+                cycles INTEGER NOT NULL DEFAULT 0,
+                automatic_offs INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, device, name)
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                device TEXT PRIMARY KEY,
+                started REAL NOT NULL,
+                name TEXT NOT NULL
+            );
+        """)
+        _sessions.clear()
+        _sessions.update((device, (started, name))
+                         for device, started, name in _connection.execute("SELECT device, started, name FROM sessions"))
+
+        # Schedules live here rather than in the configuration, so firing or adding one writes a single row
+        _connection.execute("""
+            CREATE TABLE IF NOT EXISTS schedules (
+                id INTEGER PRIMARY KEY,
+                entry TEXT NOT NULL,
+                last_run REAL
+            )
+        """)
+
+
+def close_history():
+    global _connection
+
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+def record(timestamp, user_id, name, action, device=None):
+    entry = Entry(timestamp, user_id, name, action, device)
+    with _lock:
+        _recent.append(entry)
+        if _connection is not None:
+            with _connection:
+                _connection.execute("INSERT INTO actions (timestamp, user_id, name, action, device) "
+                                    "VALUES (?, ?, ?, ?, ?)", entry)
+
+
+def recent():
+    """Returns the most recent entries, oldest first, without touching the disk."""
+    with _lock:
+        return list(_recent)
+
+
+def query(name=None, action=None, device=None, since=None, until=None, page=0, page_size=PAGE_SIZE):
+    """Returns a page of matching entries, newest first. Every filter is served by an index."""
+    conditions = list()
+    parameters = list()
+    if name is not None:
+        conditions.append("name = ?")
+        parameters.append(name)
+    if action is not None:
+        conditions.append("action = ?")
+        parameters.append(action)
+    if device is not None:
+        conditions.append("device = ?")
+        parameters.append(device)
+    if since is not None:
+        conditions.append("timestamp >= ?")
+        parameters.append(since)
+    if until is not None:
+        conditions.append("timestamp < ?")
+        parameters.append(until)
+
+    statement = "SELECT timestamp, user_id, name, action, device FROM actions"
+    if conditions:
+        statement += " WHERE " + " AND ".join(conditions)
+    statement += " ORDER BY timestamp DESC LIMIT ? OFFSET ?"
+    parameters += [page_size, page * page_size]
+
+    with _lock:
+        if _connection is None:
+            return list()
+        return [Entry(*row) for row in _connection.execute(statement, parameters)]
+
+
+def load_schedule(row):
+    entry = json.loads(row[1])
+    if row[2] is not None:
+        entry["LastRun"] = row[2]
+    return str(row[0]), entry
+
+
+def add_schedule(entry, schedule_id=None):
+    """Stores a schedule entry, and returns its ID."""
+    entry = dict(entry)
+    last_run = entry.pop("LastRun", None)
+    with _lock:
+        with _connection:
+            cursor = _connection.execute("INSERT OR REPLACE INTO schedules (id, entry, last_run) "
+                                         "VALUES (?, ?, ?)", (schedule_id, json.dumps(entry), last_run))
+    return str(cursor.lastrowid)
+
+
+def get_schedule(schedule_id):
+    with _lock:
+        if _connection is None:
+            return None
+        row = _connection.execute("SELECT id, entry, last_run FROM schedules WHERE id = ?",
+                                  (schedule_id,)).fetchone()
+    return load_schedule(row)[1] if row is not None else None
+
+
+def get_schedules():
+    """Returns every schedule entry by ID, oldest first."""
+    with _lock:
+        if _connection is None:
+            return dict()
+        rows = _connection.execute("SELECT id, entry, last_run FROM schedules ORDER BY id").fetchall()
+    return dict(load_schedule(row) for row in rows)
+
+
+def update_schedules(last_runs=None, removed=()):
+    """Sets the LastRun of the schedules in last_runs, and removes those in removed, together."""
+    with _lock:
+        with _connection:
+            _connection.executemany("UPDATE schedules SET last_run = ? WHERE id = ?",
+                                    [(run_time, schedule_id) for schedule_id, run_time in (last_runs or {}).items()])
+            _connection.executemany("DELETE FROM schedules WHERE id = ?", [(schedule_id,) for schedule_id in removed])
+
+
+def remove_schedule(schedule_id):
+    """Removes a schedule, returning whether it existed."""
+    with _lock:
+        with _connection:
+            return _connection.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,)).rowcount > 0
+
+
+def split_by_day(start, end):
+    """Yields (day, seconds) for each local day the period between the timestamps overlaps."""
+    while start < end:
+        day = datetime.date.fromtimestamp(start)
+        midnight = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+        yield day.isoformat(), min(end, midnight) - start
+        start = midnight
+
+
+def add_usage(day, device, name, on_seconds=0, cycles=0, automatic_offs=0):
+    _connection.execute("INSERT INTO daily_usage (day, device, name, on_seconds, cycles, automatic_offs) "
+                        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (day, device, name) DO UPDATE SET "
+                        "on_seconds = on_seconds + excluded.on_seconds, cycles = cycles + excluded.cycles, "
+                        "automatic_offs = automatic_offs + excluded.automatic_offs",
+                        (day, device, name, on_seconds, cycles, automatic_offs))
+
+
+def record_transition(timestamp, name, device, status, automatic=False):
+    """
+    Rolls a device turning ON or OFF into its daily usage. Each transition updates a single bucket, or one per day
+    the device stayed on for. The on-time and automatic offs count for whoever turned the device on.
+    Transitions that don't change the state, like forcing a device that is already on, are ignored.
+    """
+    with _lock:
+        if _connection is None:
+            return
+        with _connection:
+            if status == "ON" and device not in _sessions:
+                _sessions[device] = (timestamp, name)
+                _connection.execute("INSERT OR REPLACE INTO sessions (device, started, name) VALUES (?, ?, ?)",
+                                    (device, timestamp, name))
+                add_usage(datetime.date.fromtimestamp(timestamp).isoformat(), device, name, cycles=1)
+            elif status == "OFF" and device in _sessions:
+                started, starter = _sessions.pop(device)
+                _connection.execute("DELETE FROM sessions WHERE device = ?", (device,))
+                for day, seconds in split_by_day(started, timestamp):
+                    add_usage(day, device, starter, on_seconds=seconds)
+                if automatic:
+                    add_usage(datetime.date.fromtimestamp(timestamp).isoformat(), device, starter, automatic_offs=1)
+
+
+def usage(since, until, device=None, name=None):
+    """
+    Returns the Usage of every device and user in the whole days between the timestamps, summed from their daily
+    buckets, plus the on-time of the devices that are on right now.
+    """
+    first_day = datetime.date.fromtimestamp(since)
+    last_day = datetime.date.fromtimestamp(until)
+    conditions = ["day >= ?", "day <= ?"]
+    parameters = [first_day.isoformat(), last_day.isoformat()]
+    if device is not None:
+        conditions.append("device = ?")
+        parameters.append(device)
+    if name is not None:
+        conditions.append("name = ?")
+        parameters.append(name)
+
+    statement = ("SELECT device, name, SUM(on_seconds), SUM(cycles), SUM(automatic_offs) FROM daily_usage "
+                 f"WHERE {' AND '.join(conditions)} GROUP BY device, name")
+    with _lock:
+        if _connection is None:
+            return list()
+        totals = {(row[0], row[1]): Usage(*row) for row in _connection.execute(statement, parameters)}
+        sessions = dict(_sessions)
+
+    range_start = datetime.datetime.combine(first_day, datetime.time()).timestamp()
+    range_end = datetime.datetime.combine(last_day + datetime.timedelta(days=1), datetime.time()).timestamp()
+    for session_device, (started, starter) in sessions.items():
+        if (device is not None and session_device != device) or (name is not None and starter.lower() != name.lower()):
+            continue
+        seconds = max(min(range_end, time.time()) - max(range_start, started), 0)
+        current = totals.get((session_device, starter), Usage(session_device, starter, 0, 0, 0))
+        totals[(session_device, starter)] = current._replace(on_seconds=current.on_seconds + seconds)
+    return sorted(totals.values())
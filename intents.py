@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from configurations import Configuration
+
+# In priority order: when a message matches several intents, the first one wins
+DEFAULT_INTENTS = {
+    "status": ["status", "Status ❔", "סטטוס", "מצב", "estado", "statut"],
+    "on": ["on", "ON 💡", "הדלק", "תדליק", "encender", "allumer"],
+    "off": ["off", "OFF 🍗", "כבה", "תכבה", "apagar", "éteindre"],
+    "help": ["help", "Help 🤷‍♂️", "עזרה", "ayuda", "aide"],
+}
+END = None  # Trie key marking the end of an alias
+
+_compiled = (None, None)
+
+
+def compile_intents(extra_intents=None):
+    """
+    Builds a token trie of all the aliases, so a message is matched against every intent in a single pass.
+    Aliases are matched case-insensitively, as whole whitespace-separated words.
+    """
+    trie = dict()
+    for priority, (intent, aliases) in enumerate(DEFAULT_INTENTS.items()):
+        aliases = list(aliases) + list((extra_intents or {}).get(intent, []))
+        for alias in aliases:
+            node = trie
+            for token in alias.lower().split():
+                node = node.setdefault(token, dict())
+            if END not in node or node[END][0] > priority:
+                node[END] = (priority, intent)
+    return trie
+
+
+def get_trie():
+    global _compiled
+
+    extra_intents = Configuration.Intents
+    cached_intents, trie = _compiled
+    if cached_intents is not extra_intents:
+        trie = compile_intents(extra_intents)
+        _compiled = (extra_intents, trie)
+    return trie
+
+
+def match(text, trie=None):
+    """Returns (intent, unmatched tokens) for the highest priority intent in text, or (None, tokens)."""
+    trie = trie if trie is not None else get_trie()
+    tokens = text.lower().split()
+    best = None
+    best_span = (0, 0)
+    for start in range(len(tokens)):
+        node = trie
+        for end in range(start, len(tokens)):
+            node = node.get(tokens[end])
+            if node is None:
+                break
+            if END in node and (best is None or node[END][0] < best[0]):
+                best = node[END]
+                best_span = (start, end + 1)
+
+    if best is None:
+        return None, tokens
+    return best[1], tokens[:best_span[0]] + tokens[best_span[1]:]
+
+
+class Router:
+    """A single handler for free text, dispatching each message to the handler of its intent."""
+
+    def __init__(self, handlers, default, get_targets=None):
+        self.handlers = handlers
+        self.default = default
+        self.get_targets = get_targets
+
+    async def __call__(self, update, context):
+        intent, rest = match(update.message.text or "")
+        if intent is None:
+            return await self.default(update, context)
+
+        # Words naming devices or groups, like in "off bedrooms", target them as if given as command arguments
+        if self.get_targets is not None:
+            targets = {target.lower(): target for target in self.get_targets()}
+            context.args = [targets[token] for token in rest if token in targets]
+        return await self.handlers[intent](update, context)
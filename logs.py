@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+STRUCTURED_FIELDS = ("user", "action", "device", "latency")
+
+# Handlers log into the queue, and only the listener's thread ever waits on the disk
+_queue = queue.SimpleQueue()
+QUEUE_HANDLER = logging.handlers.QueueHandler(_queue)
+_listener = None
+_listener_settings = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single JSON line, with the structured fields passed through `extra`, if any."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "file": record.filename,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def compress(source, destination):
+    with open(source, "rb") as source_file, gzip.open(destination, "wb") as destination_file:
+        shutil.copyfileobj(source_file, destination_file)
+    os.remove(source)
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates when the file grows past max_bytes, or every interval seconds, optionally gzipping rotated files."""
+
+    def __init__(self, filename, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT, interval=None,
+                 compressed=True):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+        if compressed:
+            self.namer = lambda name: f"{name}.gz"
+            self.rotator = compress
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+def create_handler(path, formatter, settings=None):
+    settings = settings or dict()
+    interval = settings.get("RotateHours")
+    handler = RotatingFileHandler(path,
+                                  max_bytes=settings.get("MaxBytes", DEFAULT_MAX_BYTES),
+                                  backup_count=settings.get("BackupCount", DEFAULT_BACKUP_COUNT),
+                                  interval=interval * 3600 if interval else None,
+                                  compressed=settings.get("Compress", True))
+    handler.setFormatter(JsonFormatter() if settings.get("Format", "text") == "json" else formatter)
+    return handler
+
+
+def start(path, formatter, settings=None):
+    """
+    Writes everything logged through QUEUE_HANDLER into path from a background thread.
+    Calling it again with different settings replaces the file handler, after writing what was already queued.
+    """
+    global _listener, _listener_settings
+
+    if _listener is not None:
+        if _listener_settings == (path, settings):
+            return
+        stop()
+    _listener = logging.handlers.QueueListener(_queue, create_handler(path, formatter, settings),
+                                               respect_handler_level=True)
+    _listener_settings = (path, settings)
+    _listener.start()
+
+
+def stop():
+    """Writes the records still queued and closes the log file."""
+    global _listener, _listener_settings
+
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+    _listener_settings = None
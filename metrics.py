@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+NAMESPACE = "heatbot"
+
+_lock = threading.Lock()
+_histograms = dict()
+_counters = dict()
+_server = None
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimates the q-quantile by interpolating inside the bucket it falls in."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count > 0:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return BUCKETS[-1]
+
+
+def observe(stage, seconds):
+    with _lock:
+        if stage not in _histograms:
+            _histograms[stage] = Histogram()
+        _histograms[stage].observe(seconds)
+
+
+def increment(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+@contextmanager
+def span(stage):
+    """Times the block as stage, and counts whether it completed or raised."""
+    start_time = time.perf_counter()
+    result = "failure"
+    try:
+        yield
+        result = "success"
+    finally:
+        observe(stage, time.perf_counter() - start_time)
+        increment("stage_total", stage=stage, result=result)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def render_prometheus():
+    lines = list()
+    with _lock:
+        lines.append(f"# TYPE {NAMESPACE}_stage_seconds histogram")
+        for stage, histogram in sorted(_histograms.items()):
+            cumulative = 0
+            for bucket, bucket_count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{NAMESPACE}_stage_seconds_bucket{{stage="{stage}",le="{bucket}"}} {cumulative}')
+            lines.append(f'{NAMESPACE}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{NAMESPACE}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        for name in sorted(set(name for name, _ in _counters)):
+            lines.append(f"# TYPE {NAMESPACE}_{name} counter")
+            for (counter_name, labels), value in sorted(_counters.items()):
+                if counter_name == name:
+                    lines.append(f"{NAMESPACE}_{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    lines = list()
+    with _lock:
+        for stage, histogram in sorted(_histograms.items()):
+            lines.append(f"{stage}: n={histogram.count} "
+                         f"p50={histogram.quantile(0.5) * 1000:.0f}ms p99={histogram.quantile(0.99) * 1000:.0f}ms")
+        for (name, labels), value in sorted(_counters.items()):
+            if name != "stage_total":
+                lines.append(f"{name}{format_labels(labels)}: {value}")
+        failures = [(dict(labels)["stage"], value) for (name, labels), value in sorted(_counters.items())
+                    if name == "stage_total" and dict(labels)["result"] == "failure"]
+    for stage, value in failures:
+        lines.append(f"{stage} failures: {value}")
+    return "\n".join(lines)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the bot's log otherwise
+
+
+def start_server(port, address="127.0.0.1"):
+    global _server
+
+    if _server is not None:
+        return
+    _server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+
+
+def stop_server():
+    global _server
+
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import ConversationHandler
+
+import devices
+import heatbot
+import metrics
+import ratelimit
+import retries
+import scheduler
+import verifier
+from configurations import Configuration
+
+NOTIFICATION_TIMER = "notifications"
+COALESCE_SECONDS = 3  # Changes within this long of the first one are sent as a single message
+CONCURRENT_SENDS = 4
+GLOBAL_RATE = 30  # Messages per second Telegram allows a bot to send overall
+CHAT_RATE = 1  # Messages per second Telegram allows a bot to send to a single chat
+SEND_ATTEMPTS = 4
+
+_lock = threading.Lock()
+_changes = dict()  # Device -> (status, name, action, user_id), until the next flush
+_chat_buckets = dict()
+_global_bucket = ratelimit.TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+_retry_policy = retries.RetryPolicy(SEND_ATTEMPTS, base_delay=1.0, max_delay=30.0)
+_sends = set()
+_bot = None
+_loop = None
+_send_slots = None
+
+
+def notify(device, status, name, action, user_id=None):
+    """
+    Queues a state change for the subscribers. Changes are coalesced for COALESCE_SECONDS, and only then sent,
+    so this never waits on the Bot API. Safe to call from any thread.
+    """
+    if _loop is None or len(Configuration.Subscribers) == 0:
+        return
+    with _lock:
+        first_change = len(_changes) == 0
+        _changes[device] = (status, name, action, user_id)
+    if first_change:
+        scheduler.schedule(NOTIFICATION_TIMER, time.time() + COALESCE_SECONDS, flush)
+
+
+def get_message(changes):
+    lines = list()
+    for device, (status, name, action, _) in changes.items():
+        subject = "The heat" if devices.is_single_device() else device
+        lines.append(f"{subject} is now {status} ({action} by {name}).")
+    return "\n".join(lines)
+
+
+def flush():
+    with _lock:
+        changes = dict(_changes)
+        _changes.clear()
+    if len(changes) == 0 or _loop is None:
+        return
+
+    message = get_message(changes)
+    actors = set(change[3] for change in changes.values())
+    for chat_id in Configuration.Subscribers:
+        # Users removed since they subscribed aren't told anything, and nobody hears about only their own changes
+        if chat_id not in Configuration.Allowed or actors == {chat_id}:
+            continue
+        sending = asyncio.run_coroutine_threadsafe(send(chat_id, message), _loop)
+        with _lock:
+            _sends.add(sending)
+        sending.add_done_callback(discard_send)
+
+
+def discard_send(sending):
+    with _lock:
+        _sends.discard(sending)
+
+
+def get_chat_bucket(chat_id):
+    with _lock:
+        if chat_id not in _chat_buckets:
+            _chat_buckets[chat_id] = ratelimit.TokenBucket(CHAT_RATE, 1)
+        return _chat_buckets[chat_id]
+
+
+async def send(chat_id, message):
+    """Sends within Telegram's rate limits, retrying failures. Waiting never holds a thread, or a sending slot."""
+    for attempt in range(SEND_ATTEMPTS):
+        # Tokens are taken before a slot, so a chat waiting out its own rate doesn't hold up the others
+        await get_chat_bucket(chat_id).acquire_async()
+        await _global_bucket.acquire_async()
+        async with _send_slots:
+            try:
+                await _bot.send_message(chat_id=int(chat_id), text=message)
+                metrics.increment("notifications_total", result="sent")
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+            except BadRequest as e:
+                heatbot.logger.warning(f"Notifying {chat_id} failed: {e}")
+                break
+            except NetworkError as e:
+                delay = _retry_policy.delay(attempt)
+                heatbot.logger.warning(f"Notifying {chat_id} failed, attempt {attempt + 1}: {e}")
+            except TelegramError as e:
+                heatbot.logger.warning(f"Notifying {chat_id} failed: {e}")
+                break  # E.g. the user blocked the bot, which retrying won't change
+
+        if attempt + 1 < SEND_ATTEMPTS:
+            metrics.increment("notifications_total", result="retry")
+            await asyncio.sleep(delay)
+    metrics.increment("notifications_total", result="failure")
+
+
+def start(bot):
+    """Starts sending notifications through bot, on the running event loop."""
+    global _bot, _loop, _send_slots
+
+    _bot = bot
+    _send_slots = asyncio.Semaphore(CONCURRENT_SENDS)
+    _loop = asyncio.get_running_loop()
+
+
+async def stop():
+    """Sends the changes still being coalesced, and waits for the sends in progress."""
+    global _loop
+
+    if _loop is None:
+        return
+    scheduler.cancel(NOTIFICATION_TIMER)
+    flush()
+    with _lock:
+        sends = list(_sends)
+    _loop = None
+    await asyncio.gather(*(asyncio.wrap_future(sending) for sending in sends), return_exceptions=True)
+
+
+@verifier.verify_id
+@verifier.rate_limit("query")
+async def subscribe(update, context):
+    user_id = str(update.message.from_user["id"])
+    args = [arg.lower() for arg in context.args or []]
+    subscribed = user_id in Configuration.Subscribers
+    if len(args) == 0:
+        await update.message.reply_text(f"Notifications are {'on' if subscribed else 'off'}. "
+                                        f"Send /notify on or /notify off to change it.")
+        return ConversationHandler.END
+    if args[0] not in ("on", "off"):
+        await update.message.reply_text("Usage: /notify [on|off]")
+        return ConversationHandler.END
+
+    Configuration.transform(lambda snapshot: {
+        "Subscribers": [subscriber for subscriber in snapshot.Subscribers if subscriber != user_id] +
+                       ([user_id] if args[0] == "on" else [])})
+    Configuration.save_configuration()
+    await update.message.reply_text(f"You will {'now' if args[0] == 'on' else 'no longer'} be notified "
+                                    f"when the heat is turned on or off.")
+    return ConversationHandler.END
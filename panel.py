@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
+
+import commands
+import devices
+import heatbot
+import metrics
+import verifier
+
+CALLBACK_PREFIX = "panel"
+REFRESH_DELAY = 1  # Seconds, so a burst of changes is shown in a single edit per panel
+
+_application = None
+_loop = None
+_refresh_handle = None
+_keyboard_cache = (None, None)
+
+
+def get_keyboard():
+    global _keyboard_cache
+
+    device_map = devices.get_devices()
+    cached_devices, keyboard = _keyboard_cache
+    if cached_devices is device_map:
+        return keyboard
+
+    rows = list()
+    if not devices.is_single_device():
+        for name in device_map:
+            rows.append([InlineKeyboardButton(f"{name} ON 💡", callback_data=f"{CALLBACK_PREFIX}:on:{name}"),
+                         InlineKeyboardButton(f"{name} OFF 🍗", callback_data=f"{CALLBACK_PREFIX}:off:{name}")])
+    rows.append([InlineKeyboardButton("ON 💡", callback_data=f"{CALLBACK_PREFIX}:on"),
+                 InlineKeyboardButton("OFF 🍗", callback_data=f"{CALLBACK_PREFIX}:off")])
+    rows.append([InlineKeyboardButton("Refresh 🔄", callback_data=f"{CALLBACK_PREFIX}:status")])
+    keyboard = InlineKeyboardMarkup(rows)
+    _keyboard_cache = (device_map, keyboard)
+    return keyboard
+
+
+def get_text(panel):
+    text = commands.get_status()
+    if panel.get("note"):
+        text += "\n\n" + panel["note"]
+    return text
+
+
+def get_note(device_names, message):
+    if devices.is_single_device():
+        return message
+    return "\n".join(f"{name}: {message}" for name in device_names)
+
+
+async def show(bot, chat_id, panel):
+    """Edits the panel to the current status. Nothing is sent when it already shows it."""
+    text = get_text(panel)
+    if text == panel.get("text"):
+        return True
+    panel["text"] = text
+    try:
+        with metrics.span("reply"):
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=panel["message_id"],
+                                        reply_markup=get_keyboard())
+    except BadRequest as e:
+        if "not modified" in str(e):
+            return True
+        heatbot.logger.warning(f"Dropping the panel of chat {chat_id}: {e}")
+        return False  # Deleted, or too old to edit
+    except TelegramError as e:
+        heatbot.logger.warning(f"Updating the panel of chat {chat_id} failed: {e}")
+        panel.pop("text", None)  # Retried on the next refresh
+    return True
+
+
+async def send(update, context):
+    """Sends a new panel to the chat, replacing its previous one."""
+    previous_panel = context.chat_data.pop("panel", None)
+    if previous_panel is not None:
+        try:
+            await context.bot.delete_message(chat_id=update.effective_chat.id,
+                                             message_id=previous_panel["message_id"])
+        except TelegramError:
+            pass  # Already gone, or too old for a bot to delete
+
+    panel = dict()
+    panel["text"] = get_text(panel)
+    message = await update.message.reply_text(panel["text"], reply_markup=get_keyboard())
+    panel["message_id"] = message.message_id
+    context.chat_data["panel"] = panel
+
+
+def adopt(context, message):
+    """Returns the chat's panel, which is the message whose button was pressed, even if it wasn't known."""
+    panel = context.chat_data.get("panel")
+    if panel is None or panel["message_id"] != message.message_id:
+        panel = context.chat_data["panel"] = {"message_id": message.message_id}
+    return panel
+
+
+@verifier.rate_limit("query")
+async def refresh_button(update, context):
+    query = update.callback_query
+    await query.answer()
+    panel = adopt(context, query.message)
+    panel.pop("note", None)
+    panel.pop("text", None)  # The message may not show what we think it does, e.g. after a restart
+    await show(context.bot, update.effective_chat.id, panel)
+    await commands.add_to_log_async(update, "status")
+
+
+async def switch(update, context, action, target_status, working_message, failure_message, log_action):
+    query = update.callback_query
+    panel = adopt(context, query.message)
+    try:
+        targets = devices.resolve(context.args)
+    except ValueError as e:
+        await query.answer(f"{e}.")  # The panel was drawn before the device was removed
+        return
+
+    device_names = [name for name in targets if devices.get_state(name)[0] != target_status]
+    if len(device_names) == 0:
+        await query.answer(f"The heat is already {target_status}.")
+        panel.pop("note", None)
+        await show(context.bot, update.effective_chat.id, panel)
+        return
+
+    # Acknowledged right away, the progress and the result are shown by editing the panel itself
+    await query.answer()
+    start_time = time.perf_counter()
+    panel["note"] = get_note(device_names, working_message)
+    await show(context.bot, update.effective_chat.id, panel)
+
+    results = await asyncio.gather(*(commands.actuate_async(name, action) for name in device_names))
+    metrics.observe("actuation", time.perf_counter() - start_time)
+    for name, success in zip(device_names, results):
+        if success:
+            await commands.add_to_log_async(update, log_action, name)
+    failures = [name for name, success in zip(device_names, results) if not success]
+    panel["note"] = get_note(failures, failure_message) if len(failures) > 0 else None
+    await show(context.bot, update.effective_chat.id, panel)
+
+
+@verifier.rate_limit("actuation")
+async def on_button(update, context):
+    await switch(update, context, commands.turn_on, "ON", "Turning the heat ON…", "Failed to turn on...", "on")
+
+
+@verifier.rate_limit("actuation")
+async def off_button(update, context):
+    await switch(update, context, commands.turn_off, "OFF", "Turning the heat OFF…", "Failed to turn off...", "off")
+
+
+BUTTONS = {"status": refresh_button, "on": on_button, "off": off_button}
+
+
+@verifier.verify_id
+async def button(update, context):
+    """Handles a press on a panel button, whose data is 'panel:<action>[:<device>]'."""
+    _, action, *targets = update.callback_query.data.split(":", 2)
+    context.args = targets
+    if action not in BUTTONS:
+        await update.callback_query.answer()
+        return
+    await BUTTONS[action](update, context)
+
+
+def refresh():
+    """Updates every panel to the current status, shortly. Safe to call from any thread."""
+    if _loop is None:
+        return
+    _loop.call_soon_threadsafe(schedule_refresh)
+
+
+def schedule_refresh():
+    global _refresh_handle
+
+    if _refresh_handle is None:
+        _refresh_handle = _loop.call_later(REFRESH_DELAY, lambda: asyncio.ensure_future(refresh_all()))
+
+
+async def refresh_all():
+    global _refresh_handle
+
+    _refresh_handle = None
+    for chat_id, chat_data in list(_application.chat_data.items()):
+        panel = chat_data.get("panel")
+        if panel is not None and not await show(_application.bot, chat_id, panel):
+            chat_data.pop("panel", None)
+
+
+def start(application):
+    """Starts keeping the panels of application's chats up to date, on the running event loop."""
+    global _application, _loop
+
+    _application = application
+    _loop = asyncio.get_running_loop()
+
+
+def stop():
+    global _loop, _refresh_handle
+
+    if _refresh_handle is not None:
+        _refresh_handle.cancel()
+        _refresh_handle = None
+    _loop = None
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import copy
+import json
+import os
+import threading
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import metrics
+
+CONFIGURATION_FILE = "configuration.json"
+JOURNAL_FILE = "configuration.journal"
+BOT_STATE_FILE = "bot_state.json"
+BOT_STATE_UPDATE_SECONDS = 10
+HOT_KEYS = ("CurrentStatus", "LastChange", "DeviceStates")
+SAVE_DEBOUNCE_SECONDS = 2
+JOURNAL_COMPACTION_SIZE = 256  # Entries
+
+
+def atomic_write(path, data):
+    """Writes data to path so that a crash leaves either the old or the new file, never a partial one."""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as temp_file:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def split(configuration):
+    hot = {key: configuration[key] for key in HOT_KEYS if key in configuration}
+    cold = {key: value for key, value in configuration.items() if key not in HOT_KEYS}
+    return hot, cold
+
+
+class Store:
+    """
+    Persists the configuration in two parts:
+    - Settings (everything but HOT_KEYS) are rewritten atomically, only when they actually change.
+    - Runtime state (HOT_KEYS) is appended to a journal, which is folded back into the settings file once it grows.
+    Saves are debounced, flush() writes whatever is pending right away.
+    """
+
+    def __init__(self, path=CONFIGURATION_FILE, journal_path=JOURNAL_FILE, debounce=SAVE_DEBOUNCE_SECONDS):
+        self.path = path
+        self.journal_path = journal_path
+        self.debounce = debounce
+        self._lock = threading.Lock()
+        self._timer = None
+        self._pending = None
+        self._persisted_hot = None
+        self._persisted_cold = None
+        self._journal_entries = 0
+        self._mtime = None
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def modified_externally(self):
+        return self._stat() != self._mtime
+
+    def acknowledge_modification(self):
+        self._mtime = self._stat()
+
+    def read(self):
+        """Reads the settings with the journal replayed over them, without adopting them as persisted."""
+        with open(self.path, "r") as conf:
+            configuration = json.loads(conf.read())
+
+        journal_entries = 0
+        try:
+            with open(self.journal_path, "r") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # A torn last entry from a crash mid-append
+                    configuration.update(entry)
+                    journal_entries += 1
+        except FileNotFoundError:
+            pass
+        return configuration, journal_entries
+
+    def adopt(self, configuration, journal_entries):
+        """Marks configuration as what's currently on disk, so only later changes get written."""
+        with self._lock:
+            hot, cold = split(configuration)
+            self._persisted_hot = json.dumps(hot, sort_keys=True)
+            self._persisted_cold = json.dumps(cold, sort_keys=True)
+            self._journal_entries = journal_entries
+            self._mtime = self._stat()
+
+    def load(self):
+        configuration, journal_entries = self.read()
+        self.adopt(configuration, journal_entries)
+        return configuration
+
+    def save(self, configuration):
+        with self._lock:
+            self._pending = configuration
+            if self._timer is None:
+                self._timer = threading.Timer(self.debounce, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            configuration, self._pending = self._pending, None
+            if configuration is None:
+                return
+
+            hot, cold = split(dict(configuration))
+            serialized_hot = json.dumps(hot, sort_keys=True)
+            serialized_cold = json.dumps(cold, sort_keys=True)
+
+            # Only flushes that actually write are timed, most saves leave nothing to write
+            if serialized_cold != self._persisted_cold or self._journal_entries >= JOURNAL_COMPACTION_SIZE:
+                with metrics.span("persistence_flush"):
+                    self._compact(configuration)
+            elif serialized_hot != self._persisted_hot:
+                with metrics.span("persistence_flush"):
+                    self._append(serialized_hot)
+            self._persisted_hot = serialized_hot
+            self._persisted_cold = serialized_cold
+
+    def _append(self, serialized_hot):
+        with open(self.journal_path, "a") as journal:
+            journal.write(serialized_hot + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._journal_entries += 1
+
+    def _compact(self, configuration):
+        atomic_write(self.path, json.dumps(configuration, indent=2))
+        self._mtime = self._stat()
+        # The settings file now holds the latest runtime state, so the journal is redundant
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_entries = 0
+
+
+class BotPersistence(BasePersistence):
+    """
+    Keeps the bot's conversation states, user_data, chat_data and bot_data in a JSON file, so a restart doesn't
+    interrupt a conversation half way. The Application hands over what changed every update_interval seconds, and
+    once more on shutdown. Each batch is written together, in a single atomic write.
+    """
+
+    def __init__(self, path=BOT_STATE_FILE, update_interval=BOT_STATE_UPDATE_SECONDS):
+        super().__init__(PersistenceInput(callback_data=False), update_interval)
+        self.path = path
+        self._state = None
+        self._dirty = False
+        self._write_scheduled = False
+        self._write_lock = asyncio.Lock()
+
+    def _load(self):
+        if self._state is not None:
+            return self._state
+        try:
+            with open(self.path, "r") as state_file:
+                state = json.loads(state_file.read())
+        except FileNotFoundError:
+            state = dict()
+        # JSON keys are strings, while Telegram's IDs are numbers
+        self._state = {
+            "user_data": {int(user_id): data for user_id, data in state.get("user_data", {}).items()},
+            "chat_data": {int(chat_id): data for chat_id, data in state.get("chat_data", {}).items()},
+            "bot_data": state.get("bot_data", {}),
+            "conversations": {name: {tuple(key): value for key, value in conversation}
+                              for name, conversation in state.get("conversations", {}).items()},
+        }
+        return self._state
+
+    def _serialize(self):
+        state = self._load()
+        return json.dumps({
+            "user_data": state["user_data"],
+            "chat_data": state["chat_data"],
+            "bot_data": state["bot_data"],
+            "conversations": {name: [[list(key), value] for key, value in conversation.items()]
+                              for name, conversation in state["conversations"].items()},
+        })
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if not self._write_scheduled:
+            # Runs once the rest of the batch the Application is handing over is in, which is already queued
+            self._write_scheduled = True
+            asyncio.get_running_loop().call_soon(lambda: asyncio.ensure_future(self._write()))
+
+    async def _write(self):
+        self._write_scheduled = False
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            try:
+                data = self._serialize()
+            except (TypeError, ValueError) as e:
+                metrics.increment("bot_state_errors_total")
+                raise ValueError(f"The bot state can't be saved as JSON: {e}")
+            try:
+                with metrics.span("bot_state_flush"):
+                    await asyncio.to_thread(atomic_write, self.path, data)
+            except OSError:
+                self._dirty = True  # Written with the next batch, or on shutdown
+                raise
+
+    # Deep copies both ways, or the Application would change the stored data in place, and changes would compare equal
+    async def get_user_data(self):
+        return copy.deepcopy(self._load()["user_data"])
+
+    async def get_chat_data(self):
+        return copy.deepcopy(self._load()["chat_data"])
+
+    async def get_bot_data(self):
+        return copy.deepcopy(self._load()["bot_data"])
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return dict(self._load()["conversations"].get(name, {}))
+
+    async def update_conversation(self, name, key, new_state):
+        conversation = self._load()["conversations"].setdefault(name, dict())
+        if new_state is None:
+            if conversation.pop(key, None) is None:
+                return
+        elif conversation.get(key) == new_state:
+            return
+        else:
+            conversation[key] = new_state
+        self._mark_dirty()
+
+    async def update_user_data(self, user_id, data):
+        if len(data) == 0:
+            return await self.drop_user_data(user_id)  # Every user who ever wrote has one, mostly empty
+        if self._load()["user_data"].get(user_id) != data:
+            self._state["user_data"][user_id] = copy.deepcopy(data)
+            self._mark_dirty()
+
+    async def update_chat_data(self, chat_id, data):
+        if len(data) == 0:
+            return await self.drop_chat_data(chat_id)
+        if self._load()["chat_data"].get(chat_id) != data:
+            self._state["chat_data"][chat_id] = copy.deepcopy(data)
+            self._mark_dirty()
+
+    async def update_bot_data(self, data):
+        if self._load()["bot_data"] != data:
+            self._state["bot_data"] = copy.deepcopy(data)
+            self._mark_dirty()
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        if self._load()["user_data"].pop(user_id, None) is not None:
+            self._mark_dirty()
+
+    async def drop_chat_data(self, chat_id):
+        if self._load()["chat_data"].pop(chat_id, None) is not None:
+            self._mark_dirty()
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await self._write()
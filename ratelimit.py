@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """Allows bursts of up to burst events, refilled at rate events per second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def wait_time(self, tokens=1):
+        """Seconds until tokens are available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens or self.rate <= 0:
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Blocks until tokens are available, then takes them."""
+        while not self.try_acquire(tokens):
+            time.sleep(max(self.wait_time(tokens), 0.01))
+
+    async def acquire_async(self, tokens=1):
+        """Waits without blocking the event loop until tokens are available, then takes them."""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(max(self.wait_time(tokens), 0.01))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+
+class RetryPolicy:
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=4.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """Full jitter: a random delay up to the exponential backoff of the attempt, so retries don't synchronize."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def run(self, function, attempts=None):
+        """Calls function until it returns True, sleeping between attempts. Returns whether it ever succeeded."""
+        attempts = attempts or self.attempts
+        for attempt in range(attempts):
+            if function():
+                return True
+            if attempt < attempts - 1:
+                time.sleep(self.delay(attempt))
+        return False
+
+
+class CircuitBreaker:
+    """
+    Fails fast once a device failed failure_threshold times in a row. After reset_seconds it lets a single probe
+    through (half-open), whose result either closes the breaker or opens it again.
+    """
+
+    def __init__(self, failure_threshold=3, reset_seconds=60):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_seconds:
+                self.state = HALF_OPEN
+                return True
+            return False  # Open, or a probe is already in flight
+
+    def is_probing(self):
+        return self.state == HALF_OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name, failure_threshold=3, reset_seconds=60):
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(failure_threshold, reset_seconds)
+        breaker = _breakers[name]
+    # Follow configuration reloads
+    breaker.failure_threshold = failure_threshold
+    breaker.reset_seconds = reset_seconds
+    return breaker
+
+
+def get_breakers():
+    with _breakers_lock:
+        return dict(_breakers)
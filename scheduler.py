@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import threading
+import time
+
+import heatbot
+
+_condition = threading.Condition()
+_heap = list()
+_timers = dict()
+_sequence = itertools.count()
+_running = False
+_worker_thread = None
+
+
+class Timer:
+    def __init__(self, key, deadline, callback):
+        self.key = key
+        self.deadline = deadline
+        self.callback = callback
+        self.sequence = next(_sequence)
+
+    def __lt__(self, other):
+        return (self.deadline, self.sequence) < (other.deadline, other.sequence)
+
+
+def schedule(key, deadline, callback):
+    """
+    Arms callback to run at deadline (a time.time() timestamp). A timer already armed under key is replaced.
+    """
+    timer = Timer(key, deadline, callback)
+    with _condition:
+        _timers[key] = timer
+        heapq.heappush(_heap, timer)
+        if _heap[0] is timer:
+            _condition.notify()
+
+
+def cancel(key):
+    with _condition:
+        # The heap entry is left in place, and skipped once it reaches the top
+        return _timers.pop(key, None) is not None
+
+
+def pending():
+    with _condition:
+        return sorted((timer.deadline, timer.key) for timer in _timers.values())
+
+
+def next_timer():
+    with _condition:
+        while _running:
+            if not _heap:
+                _condition.wait()
+                continue
+
+            timer = _heap[0]
+            if _timers.get(timer.key) is not timer:
+                heapq.heappop(_heap)
+                continue
+
+            remaining = timer.deadline - time.time()
+            if remaining > 0:
+                _condition.wait(remaining)
+                continue
+
+            heapq.heappop(_heap)
+            del _timers[timer.key]
+            return timer
+        return None
+
+
+def worker():
+    while True:
+        timer = next_timer()
+        if timer is None:
+            return
+        try:
+            timer.callback()
+        except Exception as e:
+            heatbot.logger.error(f"Timer '{timer.key}' failed: {e}")
+
+
+def start():
+    global _running, _worker_thread
+
+    with _condition:
+        if _running:
+            return
+        _running = True
+    _worker_thread = threading.Thread(target=worker, name="scheduler", daemon=True)
+    _worker_thread.start()
+
+
+def stop(timeout=None):
+    global _running, _worker_thread
+
+    with _condition:
+        _running = False
+        _condition.notify()
+    if _worker_thread is not None:
+        _worker_thread.join(timeout)
+        _worker_thread = None
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import datetime
+import functools
+import time
+
+from telegram.ext import ConversationHandler
+
+import commands
+import devices
+import heatbot
+import history
+import scheduler
+import verifier
+from configurations import Configuration
+
+SCHEDULE_TIMER = "schedule"
+MISSED_POLICIES = ("skip", "run")
+MISSED_GRACE_SECONDS = 15 * 60  # How late a missed firing without a duration may still run
+DAY_NAMES = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+DAY_SETS = {"daily": tuple(range(7)), "weekdays": tuple(range(5)), "weekend": (5, 6)}
+SCHEDULE_USAGE = """Usage:
+/schedule - Lists the schedules.
+/schedule on|off HH:MM [daily|weekdays|weekend|sun,mon,...|sun-thu] [for MINUTES] [missed=skip|run] [devices]
+/schedule on|off in MINUTES [for MINUTES] [devices]
+/schedule remove ID"""
+
+
+def parse_days(value):
+    if value in DAY_SETS:
+        return DAY_SETS[value]
+
+    days = set()
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        if first not in DAY_NAMES or (last and last not in DAY_NAMES):
+            raise ValueError(f"Unknown days: '{value}'")
+        first = DAY_NAMES.index(first)
+        last = DAY_NAMES.index(last) if last else first
+        days.update(day % 7 for day in range(first, first + (last - first) % 7 + 1))
+    return tuple(sorted(days))
+
+
+def parse_minutes(value):
+    if not value.isdecimal() or int(value) == 0:
+        raise ValueError(f"Invalid number of minutes: '{value}'")
+    return int(value)
+
+
+def parse_schedule(args, now):
+    """Parses the arguments of /schedule into a new schedule entry, raising ValueError if they are invalid."""
+    args = [arg.lower() for arg in args]
+    if len(args) < 2 or args[0] not in ("on", "off"):
+        raise ValueError("Missing the action or time")
+    entry = {"Action": args[0].upper(), "Created": now}
+
+    if args[1] == "in":
+        if len(args) < 3:
+            raise ValueError("Missing the number of minutes")
+        entry["At"] = now + parse_minutes(args[2]) * 60
+        rest = args[3:]
+    else:
+        try:
+            moment = datetime.datetime.strptime(args[1], "%H:%M")
+        except ValueError:
+            raise ValueError(f"Invalid time: '{args[1]}'")
+        entry["Time"] = moment.strftime("%H:%M")
+        rest = args[2:]
+        try:
+            # Only a token that is days as a whole, "sunroom" is a device
+            days = parse_days(rest[0]) if len(rest) > 0 else None
+        except ValueError:
+            days = None
+        if days is not None:
+            entry["Days"] = days
+            rest = rest[1:]
+        else:
+            # A time without days runs once, the next time the clock shows it
+            entry["At"] = next_occurrence({"Time": entry["Time"], "Days": DAY_SETS["daily"]}, now)
+            del entry["Time"]
+
+    targets = list()
+    while len(rest) > 0:
+        arg, rest = rest[0], rest[1:]
+        if arg == "for" and len(rest) > 0:
+            entry["DurationMinutes"] = parse_minutes(rest[0])
+            rest = rest[1:]
+        elif arg.startswith("missed="):
+            if arg[len("missed="):] not in MISSED_POLICIES:
+                raise ValueError(f"Unknown missed firing policy: '{arg}'")
+            entry["Missed"] = arg[len("missed="):]
+        else:
+            targets.append(arg)
+
+    # Device and group names are stored as given, so changes to a group apply to its schedules
+    names = {target.lower(): target for target in devices.get_targets()}
+    entry["Targets"] = [names.get(target, target) for target in targets]
+    devices.resolve(entry["Targets"])
+    return entry
+
+
+def validate(entry):
+    """Raises ValueError if a stored entry, e.g. one imported from an older configuration file, is malformed."""
+    if entry.get("Action") not in ("ON", "OFF"):
+        raise ValueError(f"Action must be ON or OFF, got {entry.get('Action')!r}")
+    if ("At" in entry) == ("Time" in entry):
+        raise ValueError("It must have either At or Time and Days")
+    if "Time" in entry:
+        datetime.datetime.strptime(entry["Time"], "%H:%M")
+        if len(entry.get("Days", ())) == 0 or not set(entry["Days"]) <= set(range(7)):
+            raise ValueError("Days must be weekdays between 0 and 6")
+    for key, types in (("Created", (int, float)), ("At", (int, float)), ("DurationMinutes", (int, float)),
+                       ("LastRun", (int, float, type(None))), ("Targets", (list, tuple))):
+        if (key in entry or key == "Created") and (isinstance(entry.get(key), bool) or
+                                                   not isinstance(entry.get(key), types)):
+            raise ValueError(f"Invalid value for {key}: {entry.get(key)!r}")
+    if entry.get("Missed", "skip") not in MISSED_POLICIES:
+        raise ValueError("Missed must be skip or run")
+
+
+def import_schedules():
+    """Moves the schedules of an older configuration file, which kept them in its Schedules key, to the history."""
+    moved = Configuration.take_moved("Schedules")
+    if not moved:
+        return
+    for schedule_id, entry in moved.items():
+        try:
+            validate(entry)
+            history.add_schedule(entry, int(schedule_id))
+        except ValueError as e:
+            heatbot.logger.error(f"Dropping schedule #{schedule_id} of the configuration file: {e}")
+    # The configuration file is then rewritten without them
+    Configuration.save_configuration()
+    heatbot.logger.info(f"Moved {len(moved)} schedules from the configuration file to {history.HISTORY_FILE}.")
+
+
+def occurrence_on(entry, date):
+    hour, minute = (int(part) for part in entry["Time"].split(":"))
+    return datetime.datetime.combine(date, datetime.time(hour, minute)).timestamp()
+
+
+def next_occurrence(entry, after):
+    """Returns the first time the entry fires after the given time, or None if it never will."""
+    if "At" in entry:
+        return entry["At"] if entry["At"] > after else None
+
+    today = datetime.date.fromtimestamp(after)
+    for offset in range(8):
+        date = today + datetime.timedelta(days=offset)
+        if date.weekday() in entry["Days"] and occurrence_on(entry, date) > after:
+            return occurrence_on(entry, date)
+    return None
+
+
+def previous_occurrence(entry, before):
+    """Returns the last time the entry should have fired at or before the given time, or None."""
+    if "At" in entry:
+        return entry["At"] if entry["At"] <= before else None
+
+    today = datetime.date.fromtimestamp(before)
+    for offset in range(8):
+        date = today - datetime.timedelta(days=offset)
+        if date.weekday() in entry["Days"] and occurrence_on(entry, date) <= before:
+            return occurrence_on(entry, date)
+    return None
+
+
+def timer_key(schedule_id):
+    return f"{SCHEDULE_TIMER} {schedule_id}"
+
+
+def arm(schedule_id, entry, now):
+    """
+    Arms the entry's next firing. Each entry has a single timer armed at a time, so the scheduler's heap finds
+    the next due one, however many entries there are.
+    A firing missed while the bot was down runs late if the entry's policy is "run" and its window is still open,
+    and is skipped otherwise. Returns the skipped firing's time, if any.
+    """
+    duration = entry.get("DurationMinutes", 0) * 60
+    last_run = entry.get("LastRun")
+    if duration and last_run is not None and now < last_run + duration:
+        # Restarted in the middle of a firing's window
+        scheduler.schedule(f"{timer_key(schedule_id)} end", last_run + duration,
+                           functools.partial(end_firing, schedule_id))
+
+    missed = previous_occurrence(entry, now)
+    if missed is not None and missed > (last_run or entry["Created"]):
+        if entry.get("Missed", "skip") == "run" and now < missed + (duration or MISSED_GRACE_SECONDS):
+            heatbot.logger.info(f"Running the missed firing of schedule #{schedule_id} late.")
+            scheduler.schedule(timer_key(schedule_id), now, functools.partial(fire, schedule_id, missed))
+            return None
+        heatbot.logger.info(f"Skipped the missed firing of schedule #{schedule_id} at "
+                            f"{datetime.datetime.fromtimestamp(missed):%d.%m %H:%M}.")
+    else:
+        missed = None
+
+    next_time = next_occurrence(entry, now)
+    if next_time is None:
+        scheduler.cancel(timer_key(schedule_id))
+    else:
+        scheduler.schedule(timer_key(schedule_id), next_time, functools.partial(fire, schedule_id, next_time))
+    return missed
+
+
+def arm_all():
+    """Arms every stored schedule, and disarms the timers of schedules that no longer exist."""
+    now = time.time()
+    stale_keys = set(key for _, key in scheduler.pending() if key.startswith(f"{SCHEDULE_TIMER} "))
+    skipped = dict()
+    for schedule_id, entry in history.get_schedules().items():
+        stale_keys.difference_update((timer_key(schedule_id), f"{timer_key(schedule_id)} end"))
+        if "At" in entry and entry.get("LastRun") is not None and \
+                now >= entry["LastRun"] + entry.get("DurationMinutes", 0) * 60:
+            skipped[schedule_id] = None  # A one-off whose window ended while the bot was down
+            continue
+        missed = arm(schedule_id, entry, now)
+        if missed is not None:
+            skipped[schedule_id] = None if "At" in entry else missed
+    for key in stale_keys:
+        scheduler.cancel(key)
+
+    if len(skipped) > 0:
+        record_runs(skipped)
+
+
+def record_runs(runs):
+    """Updates the LastRun of each entry in runs, dropping one-off entries that are done."""
+    last_runs = dict()
+    removed = list()
+    for schedule_id, run_time in runs.items():
+        entry = history.get_schedule(schedule_id)
+        if entry is None:
+            continue
+        if "At" in entry and (run_time is None or not entry.get("DurationMinutes")):
+            removed.append(schedule_id)
+        else:
+            last_runs[schedule_id] = run_time
+    history.update_schedules(last_runs, removed)
+
+
+def switch(schedule_id, entry, target_status):
+    try:
+        device_names = devices.resolve(entry["Targets"])
+    except ValueError as e:
+        heatbot.logger.error(f"Schedule #{schedule_id} can't run: {e}")
+        return
+
+    action = commands.turn_on if target_status == "ON" else commands.turn_off
+    for name in device_names:
+        if devices.get_state(name)[0] != target_status:
+            commands.actuate(name, action, functools.partial(on_switched, schedule_id, name, target_status))
+
+
+def on_switched(schedule_id, device_name, target_status, success):
+    if success:
+        commands.add_to_log(None, f"scheduled {target_status.lower()}", device_name)
+    else:
+        heatbot.logger.warning(f"Schedule #{schedule_id} failed to turn '{device_name}' {target_status}")
+
+
+def fire(schedule_id, occurrence):
+    entry = history.get_schedule(schedule_id)
+    if entry is None:
+        return
+
+    switch(schedule_id, entry, entry["Action"])
+    if entry.get("DurationMinutes"):
+        scheduler.schedule(f"{timer_key(schedule_id)} end", occurrence + entry["DurationMinutes"] * 60,
+                           functools.partial(end_firing, schedule_id))
+    record_runs({schedule_id: occurrence})
+
+    next_time = next_occurrence(entry, max(occurrence, time.time()))
+    if next_time is not None:
+        scheduler.schedule(timer_key(schedule_id), next_time, functools.partial(fire, schedule_id, next_time))
+
+
+def end_firing(schedule_id):
+    entry = history.get_schedule(schedule_id)
+    if entry is None:
+        return
+
+    switch(schedule_id, entry, "OFF" if entry["Action"] == "ON" else "ON")
+    if "At" in entry:
+        record_runs({schedule_id: None})
+
+
+def describe_days(days):
+    for name, day_set in DAY_SETS.items():
+        if tuple(days) == day_set:
+            return name
+    return ",".join(DAY_NAMES[day].capitalize() for day in days)
+
+
+def describe(schedule_id, entry, now):
+    if "At" in entry:
+        when = f"once at {datetime.datetime.fromtimestamp(entry['At']):%d.%m %H:%M}"
+    else:
+        when = f"{entry['Time']} {describe_days(entry['Days'])}"
+    description = f"#{schedule_id} {entry['Action']} {when}"
+    if entry.get("DurationMinutes"):
+        description += f" for {entry['DurationMinutes']} min"
+    if entry.get("Targets"):
+        description += f" ({', '.join(entry['Targets'])})"
+    if entry.get("Missed", "skip") != "skip":
+        description += f", missed={entry['Missed']}"
+
+    next_time = next_occurrence(entry, now)
+    if next_time is not None and "At" not in entry:
+        description += f", next {datetime.datetime.fromtimestamp(next_time):%a %d.%m %H:%M}"
+    return description
+
+
+def is_visible(entry, user_id):
+    return user_id == Configuration.MasterID or entry.get("Owner") == user_id
+
+
+async def list_schedules(update, user_id):
+    now = time.time()
+    entries = await asyncio.to_thread(history.get_schedules)
+    lines = [describe(schedule_id, entry, now) for schedule_id, entry in entries.items() if is_visible(entry, user_id)]
+    await update.message.reply_text("\n".join(["Schedules:"] + lines) if len(lines) > 0 else "No schedules.")
+
+
+async def remove_schedule(update, user_id, schedule_id):
+    schedule_id = schedule_id.lstrip("#")
+    entry = await asyncio.to_thread(history.get_schedule, schedule_id) if schedule_id.isdecimal() else None
+    if entry is None or not is_visible(entry, user_id):
+        await update.message.reply_text(f"There is no schedule #{schedule_id}.")
+        return
+
+    await asyncio.to_thread(history.remove_schedule, schedule_id)
+    scheduler.cancel(timer_key(schedule_id))
+    scheduler.cancel(f"{timer_key(schedule_id)} end")
+    await update.message.reply_text(f"Removed schedule #{schedule_id}.")
+    await commands.add_to_log_async(update, "unschedule")
+
+
+async def add_schedule(update, user_id, args):
+    now = time.time()
+    try:
+        entry = parse_schedule(args, now)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}.\n{SCHEDULE_USAGE}")
+        return
+    entry["Owner"] = user_id
+    schedule_id = await asyncio.to_thread(history.add_schedule, entry)
+    arm(schedule_id, entry, now)
+    await update.message.reply_text(f"Added {describe(schedule_id, entry, now)}.")
+    await commands.add_to_log_async(update, "schedule")
+
+
+@verifier.verify_id
+@verifier.rate_limit("actuation")
+async def schedule(update, context):
+    user_id = str(update.message.from_user["id"])
+    args = context.args or []
+    if len(args) == 0:
+        await list_schedules(update, user_id)
+    elif args[0].lower() == "remove" and len(args) == 2:
+        await remove_schedule(update, user_id, args[1])
+    else:
+        await add_schedule(update, user_id, args)
+    return ConversationHandler.END
@@ -27,20 +27,119 @@
 # made specifically for Switchbot instead.
 
 import argparse
+import json
+import os
+import queue
+import socket
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from typing import List, NamedTuple, Optional
+
+# Imported by load_bluetooth() on the first connection or scan, so starting up never waits for the BLE stack
+GATTRequester = None
+DiscoveryService = None
+
+ATT_WRITE_RESPONSE = 0x13
+ATT_HANDLE_VALUE_NOTIFICATION = 0x1B
+NOTIFY_HANDLE = 0x13  # cba20003, where a Switchbot answers the commands written to it
+ENABLE_NOTIFICATIONS = b'\x01\x00'
+OK_STATUSES = (0x01, 0x05)  # 0x05 is how a Bot in press mode answers on and off, which it still performs
+_requester_classes = dict()
+
+
+def load_bluetooth():
+    global GATTRequester, DiscoveryService
+
+    if GATTRequester is None:
+        from bluetooth.ble import GATTRequester
+    if DiscoveryService is None:
+        from bluetooth.ble import DiscoveryService
+
+
+def get_requester_class():
+    """
+    Returns a GATTRequester that queues the notifications it receives, as (handle, value), so commands can wait
+    for the device's own response.
+    """
+    load_bluetooth()
+    base = GATTRequester
+    if base not in _requester_classes:
+        class NotifyingRequester(base):
+            def __init__(self, *args):
+                base.__init__(self, *args)
+                self.notifications = queue.Queue()
+
+            def on_notification(self, handle, data):
+                data = bytes(data)
+                if len(data) >= 3 and data[0] == ATT_HANDLE_VALUE_NOTIFICATION:
+                    data = data[3:]  # gattlib hands over the whole PDU, opcode and handle included
+                self.notifications.put((handle, data))
+
+        _requester_classes[base] = NotifyingRequester
+    return _requester_classes[base]
+
+
+class BasicInfo(NamedTuple):
+    battery: int
+    firmware: float
+    switch_mode: Optional[bool] = None
+    inverse_direction: Optional[bool] = None
+    hold_seconds: Optional[int] = None
 
-import bluetooth
-from bluetooth.ble import DiscoveryService, GATTRequester
+    @classmethod
+    def parse(cls, data: bytes):
+        if len(data) < 3:
+            return None
+        if len(data) < 11:
+            return cls(data[1], data[2] / 10.0)
+        return cls(data[1], data[2] / 10.0, bool(data[9] & 0x10), bool(data[9] & 0x01), data[10])
+
+
+class Result(NamedTuple):
+    """
+    The outcome of one command. status is the first byte of the device's response, or None if it didn't answer,
+    in which case only the acknowledgment of the write itself tells it went through.
+    """
+    command: str
+    acknowledged: bool
+    status: Optional[int] = None
+    data: bytes = b''
+    info: Optional[BasicInfo] = None
+
+    @property
+    def confirmed(self):
+        return self.status is not None
+
+    @property
+    def ok(self):
+        return self.status in OK_STATUSES if self.confirmed else self.acknowledged
 
+    @classmethod
+    def parse(cls, command: str, acknowledged: bool, response: Optional[bytes]):
+        if response is None or len(response) == 0:
+            return cls(command, acknowledged)
+        info = BasicInfo.parse(response) if command == 'info' and response[0] in OK_STATUSES else None
+        return cls(command, acknowledged, response[0], response, info)
 
-@contextmanager
-def connect(device: str, bt_interface: str, timeout: float):
+    def to_dict(self):
+        return {'command': self.command, 'acknowledged': self.acknowledged, 'status': self.status,
+                'data': self.data.hex()}
+
+    @classmethod
+    def from_dict(cls, result: dict):
+        return cls.parse(result['command'], result['acknowledged'],
+                         bytes.fromhex(result['data']) if result['status'] is not None else None)
+
+
+def _open(device: str, bt_interface: str, timeout: float):
+    requester_class = get_requester_class()
     if bt_interface:
-        req = GATTRequester(device, False, bt_interface)
+        req = requester_class(device, False, bt_interface)
     else:
-        req = GATTRequester(device, False)
+        req = requester_class(device, False)
 
     req.connect(False, 'random')
     connect_start_time = time.time()
@@ -51,36 +150,289 @@ def connect(device: str, bt_interface: str, timeout: float):
                                   format(device, timeout))
         time.sleep(0.1)
 
-    yield req
+    return req
+
+
+@contextmanager
+def connect(device: str, bt_interface: str, timeout: float):
+    req = _open(device, bt_interface, timeout)
+    try:
+        yield req
+    finally:
+        # Also when the block raised, or concurrent probes would leave their links open on the adapter
+        try:
+            if req.is_connected():
+                req.disconnect()
+        except RuntimeError:
+            pass
+
+
+class Connection(object):
+    """
+    A long-lived GATT link to a single device, reconnected on demand.
+    Each call makes a single connection attempt, retrying is left to the caller.
+    """
+    _keep_alive_interval = 20
+    _keep_alive_backoff_max = 320  # Seconds between keep-alive reconnects to a device that keeps failing
+    _keep_alive_max_failures = 5  # Failed reconnects in a row, after which only a successful command revives it
+
+    def __init__(self, device: str, bt_interface: str = None, timeout: float = 5):
+        self.device = device
+        self.bt_interface = bt_interface
+        self.timeout = timeout
+        self.last_connect_time = 0.0
+        self.last_write_time = 0.0
+        self._req = None
+        self._notifying = False
+        self._lock = threading.RLock()
+        self._keep_alive_stop = None
+        self._keep_alive_failures = 0
+
+    def is_connected(self):
+        try:
+            return self._req is not None and self._req.is_connected()
+        except RuntimeError:
+            return False
+
+    def _ensure_connected(self):
+        self.last_connect_time = 0.0
+        if self.is_connected():
+            return
+
+        self._drop()
+        connect_start_time = time.time()
+        try:
+            self._req = _open(self.device, self.bt_interface, self.timeout)
+        except RuntimeError as e:
+            # gattlib's errors are reported like any other failure to reach the device
+            raise ConnectionError('Connection to {} failed: {}'.format(self.device, e))
+        self.last_connect_time = time.time() - connect_start_time
+
+    def _drop(self):
+        req, self._req = self._req, None
+        self._notifying = False
+        if req is None:
+            return
+        try:
+            if req.is_connected():
+                req.disconnect()
+        except RuntimeError:
+            pass
+
+    def _subscribe(self, notify_handle: int):
+        """Subscribes to the device's responses, once per link. Devices without them are answered by acks alone."""
+        if self._notifying or not hasattr(self._req, 'notifications'):
+            return
+        try:
+            self._req.write_by_handle(notify_handle + 1, ENABLE_NOTIFICATIONS)  # Its configuration descriptor
+            self._notifying = True
+        except RuntimeError:
+            pass
+
+    def pipeline(self, writes: list, notify_handle: int = NOTIFY_HANDLE, response_timeout: float = 2.0):
+        """
+        Writes each (handle, data) back to back over the link, then collects the device's response to each one,
+        in order. Returns a list of (acknowledged, response), where response is None if none came in time.
+        """
+        with self._lock:
+            self.last_write_time = 0.0
+            self._ensure_connected()
+            self._subscribe(notify_handle)
+            notifications = self._req.notifications if self._notifying else None
+            if notifications is not None:
+                while not notifications.empty():
+                    notifications.get_nowait()  # Late answers to earlier commands that timed out
+
+            write_start_time = time.time()
+            acknowledgments = list()
+            try:
+                for handle, data in writes:
+                    result = self._req.write_by_handle(handle, data)
+                    acknowledgments.append(result == [bytes([ATT_WRITE_RESPONSE])])
+            except RuntimeError as e:
+                # The link went stale under us, the next write will reconnect
+                self._drop()
+                raise ConnectionError('Write to {} failed: {}'.format(self.device, e))
+            self._keep_alive_failures = 0
+
+            responses = list()
+            deadline = time.time() + response_timeout
+            for acknowledged in acknowledgments:
+                response = None
+                while notifications is not None and acknowledged:
+                    try:
+                        handle, value = notifications.get(timeout=max(deadline - time.time(), 0))
+                    except queue.Empty:
+                        notifications = None  # The rest won't be answered either
+                        break
+                    if handle == notify_handle:
+                        response = value
+                        break
+                responses.append(response)
+            self.last_write_time = time.time() - write_start_time
+            return list(zip(acknowledgments, responses))
+
+    def keep_alive(self):
+        """
+        Reconnects the link if it dropped, returning whether it's up. A beat is skipped while a command holds the
+        link, rather than making the command wait out a reconnect.
+        """
+        if not self._lock.acquire(blocking=False):
+            return True
+        try:
+            self._ensure_connected()
+            return True
+        except ConnectionError:
+            return False
+        finally:
+            self._lock.release()
+
+    def start_keep_alive(self, interval: float = None):
+        if self._keep_alive_stop is not None:
+            return
+        interval = interval or self._keep_alive_interval
+        self._keep_alive_stop = threading.Event()
+
+        def run(stop_event):
+            delay = interval
+            while not stop_event.wait(delay):
+                if self._keep_alive_failures >= self._keep_alive_max_failures:
+                    delay = interval  # Given up on, until a command gets through to the device again
+                elif self.keep_alive():
+                    self._keep_alive_failures = 0
+                    delay = interval
+                else:
+                    self._keep_alive_failures += 1
+                    delay = min(interval * 2 ** self._keep_alive_failures, self._keep_alive_backoff_max)
+
+        threading.Thread(target=run, args=(self._keep_alive_stop,), daemon=True).start()
+
+    def close(self):
+        if self._keep_alive_stop is not None:
+            self._keep_alive_stop.set()
+            self._keep_alive_stop = None
+        with self._lock:
+            self._drop()
+
+
+_connections = dict()
+_connections_lock = threading.Lock()
+
+
+def get_connection(device: str, bt_interface: str = None, timeout: float = 5):
+    key = (device.lower(), bt_interface)
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = Connection(device, bt_interface, timeout)
+        return _connections[key]
+
+
+def close_connections():
+    with _connections_lock:
+        connections = list(_connections.values())
+        _connections.clear()
+    for connection in connections:
+        connection.close()
+
+
+class Registry(object):
+    """
+    On-disk record of probed devices, so known devices don't need to be probed again.
+    Each entry maps an address to whether it is a Switchbot, and its command handle if it is.
+    """
+    _default_path = 'switchbot_registry.json'
+
+    def __init__(self, path: str = None):
+        self.path = path or self._default_path
+        self._devices = dict()
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as registry:
+                self._devices = json.loads(registry.read())
+        except FileNotFoundError:
+            self._devices = dict()
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._devices, indent=2, sort_keys=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as registry:
+            registry.write(data)
+            registry.flush()
+            os.fsync(registry.fileno())
+        os.replace(temp_path, self.path)
+
+    def is_known(self, device: str):
+        return device.lower() in self._devices
+
+    def is_switchbot(self, device: str):
+        entry = self._devices.get(device.lower())
+        return entry is not None and entry['switchbot']
+
+    def handle(self, device: str):
+        entry = self._devices.get(device.lower())
+        return entry.get('handle') if entry else None
 
-    if req.is_connected():
-        req.disconnect()
+    def record(self, device: str, handle: int = None):
+        with self._lock:
+            self._devices[device.lower()] = {'switchbot': handle is not None, 'handle': handle}
+
+    def switchbots(self):
+        return [device for device, entry in self._devices.items() if entry['switchbot']]
 
 
 class Scanner(object):
     service_uuid = 'cba20002-224d-11e6-9fb8-0002a5d5c51b'
     _default_scan_timeout = 8
     _default_connect_timeout = 2.0
+    _default_max_workers = 4
 
     def __init__(self, bt_interface: str = None, scan_timeout: int = None,
-                 connect_timeout: float = None):
+                 connect_timeout: float = None, max_workers: int = None,
+                 registry: Registry = None):
         self.bt_interface = bt_interface
         self.connect_timeout = connect_timeout or self._default_connect_timeout
         self.scan_timeout = scan_timeout or self._default_scan_timeout
+        self.max_workers = max_workers or self._default_max_workers
+        self.registry = registry
 
     @classmethod
-    def is_switchbot(cls, device: str, bt_interface: str, timeout: float):
+    def probe(cls, device: str, bt_interface: str, timeout: float):
+        """
+        Returns the handle of the Switchbot service on the device, or None if it isn't a Switchbot.
+        Raises ConnectionError if the device couldn't be reached, which tells nothing about what it is.
+        """
         try:
             with connect(device, bt_interface, timeout) as req:
                 for chrc in req.discover_characteristics():
                     if chrc.get('uuid') == cls.service_uuid:
                         print(' * Found Switchbot service on device {} handle {}'.
                               format(device, chrc.get('value_handle')))
-                        return True
+                        return chrc.get('value_handle')
+        except RuntimeError as e:
+            raise ConnectionError('Probing {} failed: {}'.format(device, e))
+        return None
+
+    @classmethod
+    def is_switchbot(cls, device: str, bt_interface: str, timeout: float):
+        try:
+            return cls.probe(device, bt_interface, timeout) is not None
         except ConnectionError:
             return False
 
-    def scan(self):
+    def try_probe(self, device: str):
+        """Returns whether the device could be probed, and its handle if it could."""
+        try:
+            return True, self.probe(device, self.bt_interface, self.connect_timeout)
+        except ConnectionError as e:
+            print(' * Could not probe device {}: {}'.format(device, e))
+            return False, None
+
+    def scan(self, rescan: bool = False):
+        load_bluetooth()
         if self.bt_interface:
             service = DiscoveryService(self.bt_interface)
         else:
@@ -88,9 +440,24 @@ class Scanner(object):
 
         print('Scanning for bluetooth low-energy devices')
         devices = list(service.discover(self.scan_timeout).keys())
-        print('Discovering Switchbot services')
-        return [dev for dev in devices
-                if self.is_switchbot(dev, self.bt_interface, self.connect_timeout)]
+
+        if self.registry is not None and not rescan:
+            unknown = [dev for dev in devices if not self.registry.is_known(dev)]
+        else:
+            unknown = devices
+        print('Discovering Switchbot services on {} of {} devices'.format(len(unknown), len(devices)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            outcomes = executor.map(self.try_probe, unknown)
+            # Devices that couldn't be reached stay unknown, and are probed again on the next scan
+            probed = {dev: handle for dev, (reached, handle) in zip(unknown, outcomes) if reached}
+
+        if self.registry is not None:
+            for dev, handle in probed.items():
+                self.registry.record(dev, handle)
+            self.registry.save()
+            return [dev for dev in devices if self.registry.is_switchbot(dev)]
+        return [dev for dev in devices if probed.get(dev) is not None]
 
 
 class Driver(object):
@@ -101,6 +468,7 @@ class Driver(object):
         'open': 0x0D,
         'close': 0x0D,
         'pause': 0x0D,
+        'info': 0x16,
     }
     commands = {
         'press': b'\x57\x01\x00',
@@ -109,17 +477,94 @@ class Driver(object):
         'open': b'\x57\x0F\x45\x01\x05\xFF\x00',
         'close': b'\x57\x0F\x45\x01\x05\xFF\x64',
         'pause': b'\x57\x0F\x45\x01\x00\xFF',
+        'info': b'\x57\x02',  # Answered with the battery, firmware and settings, see BasicInfo
     }
 
-    def __init__(self, device, bt_interface=None, timeout_secs=None):
+    def __init__(self, device, bt_interface=None, timeout_secs=None, persistent=False, registry=None,
+                 response_timeout=2.0):
         self.device = device
         self.bt_interface = bt_interface
         self.timeout_secs = timeout_secs if timeout_secs else 5
-
-    def run_command(self, command):
-        with connect(self.device, self.bt_interface, self.timeout_secs) as req:
-            # print('Connected!')
-            return req.write_by_handle(self.handles[command], self.commands[command])
+        self.persistent = persistent
+        self.registry = registry
+        self.response_timeout = response_timeout
+        self.connect_time = 0.0
+        self.write_time = 0.0
+
+    def handle(self, command):
+        if self.registry is not None:
+            handle = self.registry.handle(self.device)
+            if handle is not None:
+                return handle
+        return self.handles[command]
+
+    def run_commands(self, commands: List[str]) -> List[Result]:
+        """
+        Runs the commands in a single session: one connection, over which they're written back to back, and
+        answered in order. E.g. ['on', 'info'] turns a Bot on and reads back its battery and mode.
+        """
+        if self.persistent:
+            connection = get_connection(self.device, self.bt_interface, self.timeout_secs)
+            connection.start_keep_alive()
+        else:
+            connection = Connection(self.device, self.bt_interface, self.timeout_secs)
+        try:
+            replies = connection.pipeline([(self.handle(command), self.commands[command]) for command in commands],
+                                          response_timeout=self.response_timeout)
+        finally:
+            self.connect_time = connection.last_connect_time
+            self.write_time = connection.last_write_time
+            if not self.persistent:
+                connection.close()
+        return [Result.parse(command, acknowledged, response)
+                for command, (acknowledged, response) in zip(commands, replies)]
+
+    def run_command(self, command: str) -> Result:
+        return self.run_commands([command])[0]
+
+
+def serve(fd: int, max_workers: int = 8):
+    """
+    Runs Driver commands sent as JSON lines over the socket fd, replying with their results, until it's closed.
+    Pings are answered right away, so the other end can tell a hung worker from a slow command.
+    """
+    sock = socket.socket(fileno=fd)
+    registry = Registry()
+    send_lock = threading.Lock()
+
+    def reply(message):
+        data = (json.dumps(message) + '\n').encode()
+        with send_lock:
+            sock.sendall(data)
+
+    def execute(request):
+        driver = Driver(request['device'], request.get('interface'), request.get('timeout'), persistent=True,
+                        registry=registry)
+        response = {'id': request['id']}
+        try:
+            if time.time() > request['deadline']:
+                raise ConnectionError('The deadline passed before the command started')
+            response['results'] = [result.to_dict() for result in driver.run_commands(request['commands'])]
+        except Exception as e:
+            response['error'] = str(e)  # Answered either way, or the command would wait out its deadline
+        response['connect_time'] = driver.connect_time
+        response['write_time'] = driver.write_time
+        try:
+            reply(response)
+        except OSError:
+            pass  # The other end is gone, and will retry elsewhere
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    with sock.makefile('rb') as stream:
+        for line in stream:
+            request = json.loads(line)
+            if request['op'] == 'ping':
+                reply({'id': request['id'], 'pong': True})
+            elif request['op'] == 'command':
+                executor.submit(execute, request)
+    close_connections()
+    # Commands stuck in the BLE stack must not keep the process alive once nobody is waiting for them
+    os._exit(0)
 
 
 def main():
@@ -131,9 +576,9 @@ def main():
     parser.add_argument('-d', '--device', dest='device', required=False, default=None,
                         help="Specify the address of a device to control")
 
-    parser.add_argument('-c', '--command',  dest='command', required=False, default='press',
-                        choices=['press', 'on', 'off', 'open', 'close', 'pause'], 
-                        help="Command to be sent to device. \
+    parser.add_argument('-c', '--command',  dest='command', required=False, default=['press'], nargs='+',
+                        choices=['press', 'on', 'off', 'open', 'close', 'pause', 'info'],
+                        help="Commands to be sent to device, in a single session. \
                             Noted that press/on/off for Bot and open/close for Curtain. \
                             Required if the controlled device is Curtain (default: %(default)s)")
 
@@ -143,14 +588,28 @@ def main():
     parser.add_argument('--scan-timeout', dest='scan_timeout', type=int, required=False, default=2,
                         help="Device scan timeout (default: %(default)s second(s))")
 
+    parser.add_argument('--rescan', dest='rescan', required=False, default=False, action='store_true',
+                        help="Probe all discovered devices, even those already in the registry")
+
+    parser.add_argument('--registry', dest='registry', required=False, default=None,
+                        help="Path of the known devices registry (default: {})".format(Registry._default_path))
+
     parser.add_argument('--connect-timeout', dest='connect_timeout', type=int, required=False, default=5,
                         help="Device connection timeout (default: %(default)s second(s))")
 
+    parser.add_argument('--serve-fd', dest='serve_fd', type=int, required=False, default=None,
+                        help="Serve commands as a worker process over this inherited socket")
+
     opts, args = parser.parse_known_args(sys.argv[1:])
+    if opts.serve_fd is not None:
+        serve(opts.serve_fd)
+        return
+
+    registry = Registry(opts.registry)
 
     if opts.scan:
-        scanner = Scanner(opts.interface, opts.scan_timeout, opts.connect_timeout)
-        devices = scanner.scan()
+        scanner = Scanner(opts.interface, opts.scan_timeout, opts.connect_timeout, registry=registry)
+        devices = scanner.scan(opts.rescan)
 
         if not devices:
             print('No Switchbots found')
@@ -169,8 +628,14 @@ def main():
     else:
         raise RuntimeError('Please specify at least one mode between --scan and --device')
 
-    driver = Driver(device=bt_addr, bt_interface=opts.interface, timeout_secs=opts.connect_timeout)
-    driver.run_command(opts.command)
+    driver = Driver(device=bt_addr, bt_interface=opts.interface, timeout_secs=opts.connect_timeout,
+                    registry=registry)
+    for result in driver.run_commands(opts.command):
+        if not result.ok:
+            print('Command {} failed: {}'.format(result.command, result))
+            sys.exit(1)
+        if result.info is not None:
+            print('Device info: {}'.format(result.info))
     print('Command execution successful')
 
 
@@ -1,39 +1,136 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
+import functools
+import threading
+import time
+
 from telegram.ext import ConversationHandler
 
+import metrics
+import ratelimit
 from configurations import Configuration
 
+DEFAULT_RATE_LIMITS = {
+    "actuation": {"Rate": 0.2, "Burst": 3},
+    "query": {"Rate": 1.0, "Burst": 5},
+    "admin": {"Rate": 1.0, "Burst": 10},
+}
+MUTED_UNKNOWN_USERS_LIMIT = 1024
+
+_lock = threading.Lock()
+_buckets = dict()
+_throttled = set()
+_muted_unknown_users = collections.OrderedDict()
+
+
+async def reply(update, text):
+    """Replies to a message, or answers a button press with a notification, which adds nothing to the chat."""
+    if update.callback_query is not None:
+        await update.callback_query.answer(text)
+    else:
+        await update.message.reply_text(text)
+
+
+async def reject_unknown(update, user_id):
+    """Answers an unknown user once. Later messages from them are dropped without spending a Bot API call."""
+    with _lock:
+        muted = user_id in _muted_unknown_users
+        if muted:
+            _muted_unknown_users.move_to_end(user_id)
+        else:
+            _muted_unknown_users[user_id] = time.time()
+            if len(_muted_unknown_users) > MUTED_UNKNOWN_USERS_LIMIT:
+                _muted_unknown_users.popitem(last=False)
+
+    # Never awaited under the lock, other updates would block the event loop on it while this one is suspended
+    if muted:
+        metrics.increment("unknown_user_drops_total")
+        if update.callback_query is not None:
+            await update.callback_query.answer()
+        return
+    await reply(update, f"You are not allowed to use this bot! Your user id is: {user_id}.")
+    heatbot.logger.warning(f"Unknown user interacting with the bot. User ID: {user_id}.")
+
+
+def get_bucket(user_id, command_class):
+    limits = dict(DEFAULT_RATE_LIMITS[command_class])
+    limits.update(Configuration.RateLimits.get(command_class, {}))
+    key = (user_id, command_class)
+    with _lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = ratelimit.TokenBucket(limits["Rate"], limits["Burst"])
+        bucket.rate, bucket.burst = limits["Rate"], limits["Burst"]
+    return bucket
+
+
+def rate_limit(command_class):
+    """
+    Limits each user to the token bucket of the command class, configured in RateLimits.
+    Excess requests are dropped, and only the first one of a burst gets a reply.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def limited(update, context):
+            user_id = str(update.effective_user["id"])
+            key = (user_id, command_class)
+            if get_bucket(user_id, command_class).try_acquire():
+                _throttled.discard(key)
+                return await func(update, context)
+
+            metrics.increment("rate_limited_total", command_class=command_class)
+            if key not in _throttled:
+                _throttled.add(key)
+                await reply(update, "Slow down! Too many requests, try again in a few seconds.")
+            elif update.callback_query is not None:
+                await update.callback_query.answer()  # Stops the button's progress indicator
+            return None  # Leaves any ongoing conversation in its current state
+
+        return limited
+
+    return decorator
+
 
 def verify_id(func):
-    def verifier(update, context):
-        if update.message is None or update.message.from_user is None:
+    @functools.wraps(func)
+    async def verifier(update, context):
+        # Edited messages reach message handlers too, but there is nothing to answer them with
+        if (update.message is None and update.callback_query is None) or update.effective_user is None:
             return ConversationHandler.END
 
-        user = update.message.from_user
-        user_id = str(user["id"])
-        if user_id not in Configuration.Allowed:
-            update.message.reply_text(f"You are not allowed to use this bot! Your user id is: {user_id}.")
-            heatbot.logger.warning(f"Unknown user interacting with the bot. User ID: {user_id}.")
+        with metrics.span("verify"):
+            user = update.effective_user
+            user_id = str(user["id"])
+            allowed = user_id in Configuration.Allowed
+        if not allowed:
+            await reject_unknown(update, user_id)
             return ConversationHandler.END
-        return func(update, context)
+        return await func(update, context)
 
     return verifier
 
 
 def verify_master(func):
-    def verifier(update, context):
-        if update.message is None or update.message.from_user is None:
+    @functools.wraps(func)
+    async def verifier(update, context):
+        # Edited messages reach message handlers too, but there is nothing to answer them with
+        if (update.message is None and update.callback_query is None) or update.effective_user is None:
             return ConversationHandler.END
 
-        user = update.message.from_user
-        user_id = str(user["id"])
-        if user_id != Configuration.MasterID:
-            update.message.reply_text("You are not allowed to use this command! Only the master shall do that!")
+        with metrics.span("verify"):
+            user = update.effective_user
+            user_id = str(user["id"])
+            is_master = user_id == Configuration.MasterID
+        if not is_master and user_id not in Configuration.Allowed:
+            await reject_unknown(update, user_id)
+            return ConversationHandler.END
+        if not is_master:
+            await reply(update, "You are not allowed to use this command! Only the master shall do that!")
             heatbot.logger.warning(f"User trying to impersonate Master. User ID: {user_id}.")
             return ConversationHandler.END
-        return func(update, context)
+        return await func(update, context)
 
     return verifier
 